@@ -5,7 +5,7 @@ from template import Template
 from util import WakaError
 from staff_interface import StaffInterface
 from staff_tasks import StaffAction
-from board import Board
+from board import get_board
 from misc import get_cookie_from_request, kwargs_from_params, make_cookies
 from wakapost import WakaPost
 
@@ -76,6 +76,20 @@ def task_post(environ, start_response):
 
     return board.post_stuff(wakapost)
 
+# Thread updates
+def task_newposts(environ, start_response):
+    request = environ['werkzeug.request']
+    board = environ['waka.board']
+
+    try:
+        thread = int(request.values.get('thread', ''))
+        since = int(request.values.get('since', 0))
+    except ValueError:
+        environ['waka.status'] = '400 Bad Request'
+        raise WakaError('Invalid thread or post number.', plain=True)
+
+    return board.new_posts(thread, since, request.values.get('format'))
+
 # Post Deletion
 def task_delpostwindow(environ, start_response):
     request = environ['werkzeug.request']
@@ -534,7 +548,7 @@ def task_move(environ, start_response):
     )
     kwargs['parent'] = request.values.get('num', '')
     kwargs['src_brd_obj'] = environ['waka.board']
-    kwargs['dest_brd_obj'] = Board(request.values.get('destboard', ''))
+    kwargs['dest_brd_obj'] = get_board(request.values.get('destboard', ''))
     kwargs['action'] = 'thread_move'
 
     return StaffAction(**kwargs).execute()
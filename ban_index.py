@@ -0,0 +1,126 @@
+'''In-memory copy of the ban list, so that checking a post doesn't scan the
+whole admin table. IP bans go into a binary prefix trie and word bans into
+a single pattern. Each process keeps its own copy and reloads it when the
+generation counter in the database says the admin table has changed.'''
+
+import threading
+
+import config
+import model
+import misc
+
+GENERATION = 'bans'
+
+class BanIndex(object):
+    def __init__(self, rows):
+        self.trie = {}          # bit -> subtrie; None -> bans ending here
+        self.masked = []        # bans with non-contiguous netmasks
+        self.words = None
+
+        words = []
+        for row in rows:
+            if row.type == 'ipban':
+                self.add_ipban(row)
+            elif row.type == 'wordban' and row.sval1:
+                sval1 = row.sval1
+                if isinstance(sval1, str):
+                    sval1 = sval1.decode(config.CHARSET, 'replace')
+                words.append(sval1)
+
+        self.words = misc.make_literal_pattern(words)
+
+    def add_ipban(self, row):
+        try:
+            ip, mask = int(row.ival1), int(row.ival2)
+        except (TypeError, ValueError):
+            return
+        ban = (row.num, row.comment)
+
+        prefix = prefix_length(mask)
+        if prefix is None:
+            self.masked.append((ip & mask, mask, ban))
+            return
+
+        node = self.trie
+        for bit in xrange(prefix):
+            node = node.setdefault((ip >> (31 - bit)) & 1, {})
+        node.setdefault(None, []).append(ban)
+
+    def find_ipban(self, numip):
+        '''Returns the (num, comment) of the oldest ban matching numip, or
+        None'''
+
+        try:
+            numip = int(numip)
+        except ValueError:
+            return None
+        found = []
+
+        node = self.trie
+        for bit in xrange(33):
+            found.extend(node.get(None, []))
+            if bit == 32:
+                break
+            node = node.get((numip >> (31 - bit)) & 1)
+            if node is None:
+                break
+
+        for network, mask, ban in self.masked:
+            if numip & mask == network:
+                found.append(ban)
+
+        if not found:
+            return None
+        return min(found)
+
+    def find_word(self, *texts):
+        if self.words is None:
+            return False
+        for text in texts:
+            if self.words.search(text) is not None:
+                return True
+        return False
+
+def prefix_length(mask):
+    '''Number of leading ones in a netmask, or None if it has holes'''
+
+    inverted = ~mask & 0xffffffff
+    if inverted & (inverted + 1):
+        return None
+    return 32 - inverted.bit_length()
+
+_index = None
+_generation = None
+_lock = threading.Lock()
+
+def get_generation():
+    return model.get_counter(GENERATION)
+
+def bump_generation():
+    '''Tell every process that the admin table has changed. Call it in the
+    same transaction as the change.'''
+
+    global _generation
+
+    model.bump_counter(GENERATION)
+    with _lock:
+        _generation = None
+
+def get_index():
+    '''Returns the BanIndex, reloading it if it's stale'''
+
+    global _index, _generation
+
+    generation = get_generation()
+    with _lock:
+        if _index is not None and _generation == generation:
+            return _index
+
+    session = model.Session()
+    table = model.admin
+    sql = table.select().where(table.c.type.in_(['ipban', 'wordban']))
+    index = BanIndex(session.execute(sql))
+
+    with _lock:
+        _index, _generation = index, generation
+    return index
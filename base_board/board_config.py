@@ -31,7 +31,7 @@ config['MAX_AGE'] = 0				# Maximum age of a thread in hours (set to 0 to disable
 config['MAX_MEGABYTES'] = 0			# Maximum size to use for all images in megabytes (set to 0 to disable)
 config['MAX_FIELD_LENGTH'] = 100		# Maximum number of characters in subject, name, and email
 config['MAX_COMMENT_LENGTH'] = 8192		# Maximum number of characters in a comment
-config['MAX_LINES_SHOWN'] = 15			# Max lines shown per post (0 = no limit)
+config['MAX_LINES_SHOWN'] = 15			# Max lines shown per post (0 = no limit). Run update_abbreviations after changing
 config['MAX_IMAGE_WIDTH'] = 16384		# Maximum width of image before rejecting
 config['MAX_IMAGE_HEIGHT'] = 16384		# Maximum height of image before rejecting
 config['MAX_IMAGE_PIXELS'] = 50000000		# Maximum width*height of image before rejecting
@@ -104,6 +104,7 @@ config['STYLE_COOKIE'] = 'wakastyle'		# Name of the board's style cookie. Genera
 # Internal paths and files - might as well leave this alone.
 config['IMG_DIR'] = 'src/'			# Image directory (needs to be writeable by the script)
 config['THUMB_DIR'] = 'thumb/'			# Thumbnail directory (needs to be writeable by the script)
+config['SHARD_DIRS'] = 0			# Levels of subdirectories that IMG_DIR and THUMB_DIR are split into, picked by a hash of the file name (0: none, 1: src/ab/, 2: src/ab/cd/). Helps boards with hundreds of thousands of files. Run "wakarimasen.py shard_files" after changing it.
 config['RES_DIR'] = 'res/'			# Reply cache directory (needs to be writeable by the script)
 config['ARCHIVE_DIR'] = 'arch/'			# Root of archive directories (all need to be writeable by the script)
 config['BACKUP_DIR'] = "backup/"		# Subdirectory in ARCHIVE_DIR for all backup images and thumbnails.
@@ -2,9 +2,13 @@ import os
 import re
 import time
 import sys
+import json
+import shutil
+import functools
+import multiprocessing
 import hashlib
 import mimetypes
-from subprocess import Popen, PIPE
+from subprocess import Popen
 
 import misc
 import str_format
@@ -14,10 +18,16 @@ import staff
 import staff_interface
 # NOTE: I'm not sure if interboard is a good module to have here.
 import interboard
+import rebuild_queue
+import post_cache
+import sniff
+import proxy_check
+import upload
+import thumbnail as thumbnail_backend
 import config
 import strings as strings
 from util import WakaError, local
-from template import Template
+from template import Template, write_page
 from wakapost import WakaPost
 
 try:
@@ -27,6 +37,31 @@ except ImportError:
 
 from sqlalchemy.sql import case, or_, and_, select, func, null
 
+# Thread numbers shown on each index page as of the last build_cache(),
+# used to figure out which pages need rebuilding.
+PAGE_STATE_FILE = '.pagestate'
+
+# Number of threads fetched per query by a full rebuild
+THREAD_BATCH_SIZE = 50
+
+# Number of posts updated per transaction by update_abbreviations()
+ABBREVIATION_BATCH_SIZE = 500
+
+# Number of posts whose files are moved at a time by shard_files()
+SHARD_BATCH_SIZE = 500
+
+# Held while writing a board's pages, so that rebuilds queue up in order
+WRITE_LOCK_FILE = '.pages'
+
+def write_locked(f):
+    '''Decorator for Board methods that write pages'''
+
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with self.write_lock():
+            return f(self, *args, **kwargs)
+    return wrapper
+
 class Board(object):
     def __init__(self, board):
         # Correct for missing key when running under WSGI
@@ -43,7 +78,7 @@ class Board(object):
         if not os.path.exists(os.path.join(board_path, 'board_config.py')):
             raise BoardNotFound('Board configuration not found.')
 
-        module = util.import2('board_config', board_path)
+        module = util.import2('board_config', board_path, reload=True)
 
         if board_config_defaults:
             self.options = board_config_defaults.config.copy()
@@ -109,6 +144,17 @@ class Board(object):
         kwargs['url'] = True
         return self.make_path(**kwargs)
 
+    def get_file_path(self, name, dirc):
+        '''Path of the file called name in IMG_DIR or THUMB_DIR (dirc),
+        relative to the board. With SHARD_DIRS set, it's that many levels
+        of subdirectories down, picked by a hash of the name.'''
+
+        key = name.encode('utf-8') if isinstance(name, unicode) else name
+        digest = hashlib.md5(key).hexdigest()
+        shards = [digest[i * 2:i * 2 + 2]
+                  for i in xrange(self.options.get('SHARD_DIRS', 0))]
+        return os.path.join(self.options[dirc], *(shards + [name]))
+
     def _get_all_threads(self):
         '''Build a list of threads from the database,
         where each thread is a list of WakaPost instances'''
@@ -169,29 +215,158 @@ class Board(object):
 
         return [thread_dict[num] for num in thread_nums]
 
-    def build_cache(self):
-        threads = self._get_all_threads()
+    def get_thread_order(self):
+        '''Thread numbers in the order they are shown on the index pages'''
 
-        per_page = self.options['IMAGES_PER_PAGE']
-        total = get_page_count(threads, per_page)
+        session = model.Session()
+        table = self.table
+        sql = select([table.c.num], table.c.parent == 0).order_by(
+            table.c.stickied.desc(),
+            table.c.lasthit.desc(),
+            table.c.num.asc()
+        )
+        return [row[0] for row in session.execute(sql)]
+
+    def get_threads(self, thread_nums):
+        '''Fetch only the given threads, in the given order, as lists of
+        WakaPost instances'''
 
-        for page in xrange(total):
-            pagethreads = threads[page * per_page:\
-                          min(len(threads), (page + 1) * per_page)]
-            self.build_cache_page(page, total, pagethreads)
+        if not thread_nums:
+            return []
+
+        session = model.Session()
+        table = self.table
+        thread_dict = {}
+
+        sql = table.select().where(table.c.num.in_(thread_nums))
+        for op in session.execute(sql):
+            thread_dict[op.num] = [WakaPost(op)]
+
+        sql = table.select().where(table.c.parent.in_(thread_nums))\
+                   .order_by(table.c.num.asc())
+        for post in session.execute(sql):
+            if post.parent in thread_dict:
+                thread_dict[post.parent].append(WakaPost(post))
+
+        return [thread_dict[num] for num in thread_nums if num in thread_dict]
+
+    def write_lock(self):
+        '''Lock held while writing the board's pages. Don't write to the
+        database while holding it, since writers take them the other way
+        around.'''
+        return util.FileLock(os.path.join(self.path, WRITE_LOCK_FILE))
+
+    @write_locked
+    def build_cache(self, changed_threads=None):
+        '''Build the index pages. If changed_threads is given, only the pages
+        whose list of threads moved since the last build, or which show one
+        of changed_threads, are rebuilt. Returns the rebuilt page numbers.'''
+
+        per_page = self.options['IMAGES_PER_PAGE']
+        order = self.get_thread_order()
+        pages = [order[i:i + per_page]
+                 for i in xrange(0, len(order), per_page)] or [[]]
+        total = len(pages)
+
+        old_pages = None
+        if changed_threads is not None:
+            old_pages = self._load_page_state()
+
+        if old_pages is None or len(old_pages) != total:
+            # page links change everywhere when the page count does
+            dirty = range(total)
+        else:
+            changed = set(changed_threads)
+            dirty = [page for page in xrange(total)
+                     if pages[page] != old_pages[page]
+                        or changed.intersection(pages[page])]
+
+        if len(dirty) == total:
+            threads = self._get_all_threads()
+            for page in dirty:
+                pagethreads = threads[page * per_page:\
+                              min(len(threads), (page + 1) * per_page)]
+                self.build_cache_page(page, total, pagethreads)
+        else:
+            for page in dirty:
+                self.build_cache_page(page, total,
+                                      self.get_threads(pages[page]))
 
         # check for and remove old pages
         page = total
-        while os.path.exists(self.make_path(page=page)):
-            os.unlink(self.make_path(page=page))
+        while self.delete_page(self.make_path(page=page)):
             page += 1
 
         if config.ENABLE_RSS:
             self.update_rss()
 
-    def rebuild_cache(self):
-        self.build_thread_cache_all()
+        self._save_page_state(pages)
+
+        return dirty
+
+    def write_json(self, filename, data):
+        '''Write the JSON version of the page in filename'''
+        write_page(self, json_filename(filename), self.make_json(data))
+
+    def make_json(self, data):
+        data['board'] = self.name
+        data['url'] = self.url
+        return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+    def delete_page(self, filename):
+        '''Delete a generated page along with its .gz and JSON versions, if
+        they exist. Returns whether the page existed.'''
+
+        existed = os.path.exists(filename)
+        for name in (json_filename(filename), filename):
+            if os.path.exists(name + '.gz'):
+                os.unlink(name + '.gz')
+            if os.path.exists(name):
+                os.unlink(name)
+                self.log_changed_page(name)
+        return existed
+
+    def log_changed_page(self, filename):
+        '''Append the url of a page that was written or deleted to
+        CHANGED_URLS_FILE, for purging it from caches'''
+
+        if not config.CHANGED_URLS_FILE:
+            return
+
+        url = self.url + str_format.percent_encode(
+            os.path.relpath(filename, self.path))
+
+        # a single write() with O_APPEND, so that lines written by several
+        # processes at once don't get mixed up
+        fd = os.open(config.CHANGED_URLS_FILE,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, url + '\n')
+        finally:
+            os.close(fd)
+
+    def _load_page_state(self):
+        try:
+            with open(os.path.join(self.path, PAGE_STATE_FILE)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _save_page_state(self, pages):
+        filename = os.path.join(self.path, PAGE_STATE_FILE)
+        tempname = filename + '.tmp%d' % os.getpid()
+        with open(tempname, 'w') as f:
+            json.dump(pages, f)
+        os.rename(tempname, filename)
+
+    @write_locked
+    def rebuild_cache(self, jobs=1):
+        '''Rebuild every page of the board, with jobs worker processes for
+        the thread pages. Returns the number of threads built.'''
+
+        count = self.build_thread_cache_all(jobs)
         self.build_cache()
+        return count
 
     def rebuild_cache_proxy(self, task_data):
         task_data.user.check_access(self.name)
@@ -236,10 +411,17 @@ class Board(object):
 
             thread['posts'] = [parent] + replies
 
+            # whether to link to the abbreviated thread page
+            thread['last_link'] = bool(config.ENABLE_ABBREVIATED_THREAD_PAGES
+                and thread['omit'] and thread['omit']
+                    + self.options['REPLIES_PER_THREAD']
+                    > config.POSTS_IN_ABBREVIATED_THREAD_PAGES)
+
             for post in thread['posts']:
-                abbreviation = abbreviate_html(post.comment,
-                    self.options['MAX_LINES_SHOWN'],
-                    self.options['APPROX_LINE_LENGTH'])
+                abbreviation = post.abbreviation
+                if abbreviation is None:
+                    # posted before abbreviations were stored
+                    abbreviation = self.abbreviate(post.comment)
 
                 if abbreviation:
                     post.abbrev = 1
@@ -302,6 +484,17 @@ class Board(object):
             threads=threads,
         ).render_to_file(filename)
 
+        if config.JSON_PAGES:
+            self.write_json(filename, {
+                'page': page,
+                'pages': total,
+                'threads': [{
+                    'omit': thread['omit'],
+                    'omitimages': thread['omitimages'],
+                    'posts': [post.json_values for post in thread['posts']],
+                } for thread in threads],
+            })
+
     def get_thread_posts(self, threadid):
         session = model.Session()
         sql = self.table.select(
@@ -324,10 +517,72 @@ class Board(object):
 
         return thread
 
+    def get_new_posts(self, threadid, since):
+        '''The replies to a thread numbered above since. Raises WakaError if
+        the thread doesn't exist.'''
+
+        session = model.Session()
+        table = self.table
+        sql = table.select().where(and_(table.c.parent == threadid,
+                                        table.c.num > since))\
+                   .order_by(table.c.num.asc())
+        posts = [WakaPost(row) for row in session.execute(sql)]
+
+        if not posts and not self.get_parent_post(threadid).num:
+            local.environ['waka.status'] = '404 Not Found'
+            raise WakaError(strings.NOTHREADERR, plain=True)
+        return posts
+
+    def new_posts(self, threadid, since, format='json'):
+        '''Pseudo-application to send the replies to a thread numbered above
+        since, as JSON or as HTML for appending to the thread page'''
+
+        posts = self.get_new_posts(threadid, since)
+
+        if format == 'html':
+            contents = Template('new_posts', thread=threadid,
+                                posts=posts).render()
+            content_type = 'text/html'
+        else:
+            contents = self.make_json({
+                'thread': threadid,
+                'posts': [post.json_values for post in posts],
+            })
+            content_type = 'application/json'
+
+        return util.make_conditional_response(contents, content_type)
+
+    def get_thread_range(self, first, last):
+        '''Fetch the threads numbered from first to last with two queries,
+        as a dict of thread number to list of WakaPost instances'''
+
+        session = model.Session()
+        table = self.table
+        thread_dict = {}
+
+        sql = table.select().where(and_(table.c.parent == 0,
+                                        table.c.num >= first,
+                                        table.c.num <= last))
+        for op in session.execute(sql):
+            thread_dict[op.num] = [WakaPost(op)]
+
+        sql = table.select().where(and_(table.c.parent >= first,
+                                        table.c.parent <= last))\
+                   .order_by(table.c.num.asc())
+        for post in session.execute(sql):
+            if post.parent in thread_dict:
+                thread_dict[post.parent].append(WakaPost(post))
+
+        return thread_dict
+
+    @write_locked
     def build_thread_cache(self, threadid):
         '''Build $rootpath/$board/$res/$threadid.html'''
 
-        thread = self.get_thread_posts(threadid)
+        self.write_thread_cache(threadid, self.get_thread_posts(threadid))
+
+    def write_thread_cache(self, threadid, thread):
+        '''Write the pages of a thread, given its list of posts'''
 
         filename = os.path.join(self.path, self.options['RES_DIR'],
             "%s%s" % (threadid, config.PAGE_EXT))
@@ -348,6 +603,12 @@ class Board(object):
 
         print_thread(thread, filename)
 
+        if config.JSON_PAGES:
+            self.write_json(filename, {
+                'thread': int(threadid),
+                'posts': [post.json_values for post in thread],
+            })
+
         # Determine how many posts need to be cut.
         posts_to_trim = len(thread) - config.POSTS_IN_ABBREVIATED_THREAD_PAGES
 
@@ -369,8 +630,7 @@ class Board(object):
             print_thread(thread, abbreviated_filename,
                 omit=posts_to_trim - 1, min_res=min_res)
         else:
-            if os.path.exists(abbreviated_filename):
-                os.unlink(abbreviated_filename)
+            self.delete_page(abbreviated_filename)
 
     def delete_thread_cache(self, parent, archiving):
         archive_dir = self.options['ARCHIVE_DIR']
@@ -417,18 +677,67 @@ class Board(object):
 
                         res_out.write(line)
 
-        if os.path.exists(full_thread_page):
-            os.unlink(full_thread_page)
-        if os.path.exists(abbrev_thread_page):
-            os.unlink(abbrev_thread_page)
+        self.delete_page(full_thread_page)
+        self.delete_page(abbrev_thread_page)
 
-    def build_thread_cache_all(self):
-        session = model.Session()
-        sql = select([self.table.c.num], self.table.c.parent == 0)
-        query = session.execute(sql)
+        post_cache.forget_thread(self, parent)
+
+    @write_locked
+    def build_thread_cache_all(self, jobs=1):
+        '''Build every thread page, splitting the threads between jobs
+        worker processes. Returns the number of threads built.
+
+        Only the command line should ask for more than one job: forking a
+        server process copies its threads' state along with it.'''
 
-        for row in query:
-            self.build_thread_cache(row[0])
+        session = model.Session()
+        sql = select([self.table.c.num], self.table.c.parent == 0)\
+              .order_by(self.table.c.num.asc())
+        thread_nums = [row[0] for row in session.execute(sql)]
+
+        jobs = max(1, min(jobs, len(thread_nums)))
+        if jobs == 1:
+            self._build_threads(thread_nums)
+            return len(thread_nums)
+
+        # the workers can't share our database connections, so close them
+        # before forking, keeping what was written; everyone opens new ones
+        # as needed
+        session.commit()
+        model.Session.remove()
+        model.engine.dispose()
+        sys.stdout.flush()
+
+        per_job = (len(thread_nums) + jobs - 1) // jobs
+        workers = []
+        for i in xrange(0, len(thread_nums), per_job):
+            worker = multiprocessing.Process(target=self._build_threads,
+                                             args=(thread_nums[i:i + per_job],))
+            worker.start()
+            workers.append(worker)
+
+        failed = 0
+        for worker in workers:
+            worker.join()
+            if worker.exitcode:
+                failed += 1
+
+        if failed:
+            raise WakaError('Rebuild failed in %d of %d workers.'
+                            % (failed, len(workers)))
+
+        return len(thread_nums)
+
+    def _build_threads(self, thread_nums):
+        '''Build the given thread pages, fetching them in batches of
+        consecutive thread numbers'''
+
+        for i in xrange(0, len(thread_nums), THREAD_BATCH_SIZE):
+            batch = thread_nums[i:i + THREAD_BATCH_SIZE]
+            threads = self.get_thread_range(batch[0], batch[-1])
+            for num in batch:
+                if num in threads:
+                    self.write_thread_cache(num, threads[num])
 
     def _handle_post(self, wakapost, editing=None, admin_data=None):
         """Worst function ever"""
@@ -476,7 +785,7 @@ class Board(object):
 
             # check for open proxies
             if self.options['ENABLE_PROXY_CHECK']:
-                self.proxy_check(ip)
+                proxy_check.check(ip, self.options)
 
         # check if thread exists, and get lasthit value
         parent_res = None
@@ -500,6 +809,9 @@ class Board(object):
         self.flood_check(numip, timestamp, wakapost.comment,
             wakapost.req_file, editing is None, False)
 
+        # cut down comment for index pages
+        wakapost.abbreviation = self.abbreviate(wakapost.comment)
+
         # generate date
         wakapost.set_date(editing, self.options['DATE_STYLE'])
 
@@ -523,7 +835,8 @@ class Board(object):
         else:
             db_update = self.table.insert()
 
-        db_update = db_update.values(**wakapost.db_values)
+        db_update = db_update.values(
+            **model.known_values(self.table, wakapost.db_values))
 
         # finally, write to the database
         result = session.execute(db_update)
@@ -534,14 +847,30 @@ class Board(object):
 
             wakapost.num = result.inserted_primary_key[0]
 
-        # remove old threads from the database
-        self.trim_database()
+        thread = wakapost.parent or wakapost.num
 
-        # update the cached HTML pages
-        self.build_cache()
+        if config.REBUILD_QUEUE:
+            # the index pages are left to the worker, which also trims
+            rebuild_queue.queue_rebuild(self, [thread])
+        else:
+            # remove old threads from the database
+            self.trim_database()
+
+        # the pages must be built from committed rows: a concurrent post
+        # rendering them could otherwise miss this one and record the
+        # pages as up to date
+        session.commit()
 
-        # update the individual thread cache
-        self.build_thread_cache(wakapost.parent or wakapost.num)
+        if 'waka.thumbnails' in local.environ:
+            thumbnail_backend.start_deferred(self, wakapost.num, thread)
+
+        with self.write_lock():
+            if not config.REBUILD_QUEUE:
+                # update the cached HTML pages
+                self.build_cache(changed_threads=[thread])
+
+            # update the individual thread cache, where noko goes
+            self.build_thread_cache(thread)
 
         return wakapost.num
 
@@ -623,6 +952,15 @@ class Board(object):
             task_data.contents.append(ip + ' (' + mask + ')' + ' @ ' \
                                       + self.name)
 
+        touched = self.delete_posts_by_ip(ip, mask)
+        if touched:
+            model.Session().commit()
+            self.rebuild_threads(touched)
+
+    def delete_posts_by_ip(self, ip, mask='255.255.255.255'):
+        '''Delete the recent posts from ip without rebuilding any pages.
+        Returns the set of threads that lost posts.'''
+
         try:
             ip = int(ip)
         except ValueError:
@@ -636,27 +974,160 @@ class Board(object):
         session = model.Session()
         table = self.table
 
-        sql = table.select().where(and_(
+        sql = select([table.c.num], and_(
             table.c.ip.op('&')(mask) == ip & mask,
             table.c.timestamp > (time.time() - config.NUKE_TIME_THRESHOLD)
         ))
-        rows = session.execute(sql)
-
-        if not rows.rowcount:
-            return
+        posts = [row.num for row in session.execute(sql)]
 
         timestamp = None
         if config.POST_BACKUP:
             timestamp = time.time()
 
-        for row in rows:
+        touched = set()
+        for num in posts:
             try:
-                self.delete_post(row.num, '', False, False, admin=True,
-                                 timestampofarchival=timestamp)
+                touched.add(self.delete_post(num, '', False, False,
+                    admin=True, timestampofarchival=timestamp,
+                    rebuild=False))
             except WakaError:
+                # went along with its thread
                 pass
 
-        self.build_cache()
+        return touched
+
+    @write_locked
+    def rebuild_threads(self, threads):
+        '''Build the pages of the given threads that still exist, and the
+        index pages showing them. Returns the rebuilt index page numbers.'''
+
+        threads = [thread for thread in threads if thread]
+        for thread in threads:
+            try:
+                self.build_thread_cache(thread)
+            except WakaError:
+                # deleted since
+                pass
+
+        return self.build_cache(changed_threads=threads)
+
+    def update_abbreviations(self):
+        '''Recompute the stored abbreviated comments, e.g. after changing
+        MAX_LINES_SHOWN or APPROX_LINE_LENGTH. Commits after each batch of
+        posts. Returns the set of threads with changed posts.'''
+
+        session = model.Session()
+        table = self.table
+        if 'abbreviation' not in table.c:
+            raise WakaError('Run "wakarimasen.py create_columns" first.')
+
+        threads = set()
+        last = 0
+        while True:
+            sql = select([table.c.num, table.c.parent, table.c.comment,
+                          table.c.abbreviation], table.c.num > last)\
+                  .order_by(table.c.num.asc()).limit(ABBREVIATION_BATCH_SIZE)
+            rows = session.execute(sql).fetchall()
+            if not rows:
+                break
+
+            for row in rows:
+                abbreviation = self.abbreviate(row.comment)
+                if abbreviation != row.abbreviation:
+                    session.execute(table.update()
+                        .where(table.c.num == row.num)
+                        .values(abbreviation=abbreviation))
+                    threads.add(row.parent or row.num)
+
+            session.commit()
+            last = rows[-1].num
+
+        return threads
+
+    def shard_files(self):
+        '''Move images and thumbnails to where get_file_path() puts them,
+        e.g. after changing SHARD_DIRS, a batch of posts at a time. Each
+        file is linked to its new path before the posts and their pages are
+        updated, and unlinked from the old one after, so that the board can
+        stay up meanwhile. Returns the number of files moved.'''
+
+        session = model.Session()
+        table = self.table
+
+        moved = 0
+        last = 0
+        while True:
+            sql = select([table.c.num, table.c.parent, table.c.image,
+                          table.c.thumbnail], table.c.num > last)\
+                  .order_by(table.c.num.asc()).limit(SHARD_BATCH_SIZE)
+            rows = session.execute(sql).fetchall()
+            if not rows:
+                break
+
+            threads = set()
+            old_files = []
+            for row in rows:
+                values = {}
+                image = self._link_sharded(row.image, 'IMG_DIR')
+                if image:
+                    values['image'] = image
+                    old_files.append(row.image)
+
+                if row.thumbnail and row.thumbnail == row.image:
+                    # small images are their own thumbnail
+                    if image:
+                        values['thumbnail'] = image
+                else:
+                    thumbnail = self._link_sharded(row.thumbnail, 'THUMB_DIR')
+                    if thumbnail:
+                        values['thumbnail'] = thumbnail
+                        old_files.append(row.thumbnail)
+
+                if values:
+                    session.execute(table.update()
+                        .where(table.c.num == row.num).values(**values))
+                    threads.add(row.parent or row.num)
+
+            session.commit()
+            self.rebuild_threads(threads)
+
+            for filename in old_files:
+                os.unlink(os.path.join(self.path, filename))
+            moved += len(old_files)
+            last = rows[-1].num
+
+        return moved
+
+    def _link_sharded(self, filename, dirc):
+        '''Links the file at filename (relative to the board) to where
+        get_file_path() puts it. Returns the new path, or None if it's
+        there already or isn't a file of dirc.'''
+
+        if not filename or not filename.startswith(self.options[dirc]):
+            # no file, or an icon
+            return None
+
+        new_filename = self.get_file_path(os.path.basename(filename), dirc)
+        if new_filename == filename:
+            return None
+
+        full_path = os.path.join(self.path, filename)
+        new_full_path = os.path.join(self.path, new_filename)
+        if not os.path.exists(full_path):
+            return None
+
+        util.make_dirs(os.path.dirname(new_full_path))
+        try:
+            os.link(full_path, new_full_path)
+        except OSError:
+            if not os.path.exists(new_full_path):
+                # no hard links on this filesystem
+                shutil.copy2(full_path, new_full_path)
+            elif not os.path.samefile(full_path, new_full_path):
+                # some other file has the name
+                return None
+            # else linked by a run that was interrupted
+        return new_filename
 
     def delete_stuff(self, posts, password, file_only, archiving,
                      caller='user', admindelete=False,
@@ -669,13 +1140,15 @@ class Board(object):
         if config.POST_BACKUP:
             timestamp = time.time()
 
+        touched = set()
         for post in posts:
-            self.delete_post(post, password, file_only, archiving,
-                             from_window=False, admin=admindelete,
-                             timestampofarchival=timestamp,
-                             admin_data=admin_data)
+            touched.add(self.delete_post(post, password, file_only, archiving,
+                                         from_window=False, admin=admindelete,
+                                         timestampofarchival=timestamp,
+                                         admin_data=admin_data))
 
-        self.build_cache()
+        model.Session().commit()
+        self.build_cache(changed_threads=touched)
 
         if admindelete:
             forward = misc.make_script_url(task='mpanel', board=self.name)
@@ -686,9 +1159,10 @@ class Board(object):
 
     def delete_post(self, post, password, file_only, archiving,
                     admin_data=None, from_window=False, admin=False,
-                    timestampofarchival=None, recur=False):
+                    timestampofarchival=None, recur=False, rebuild=True):
         '''Delete a single post from the board. This method does not rebuild
-        index cache automatically.'''
+        index cache automatically, nor the thread page if rebuild is False.
+        Returns the number of the thread the post belonged to.'''
 
         session = model.Session()
         table = self.table
@@ -789,17 +1263,20 @@ class Board(object):
         if not row.parent:
             if file_only:
                 # removing parent (OP) image
-                self.build_thread_cache(post)
+                if rebuild:
+                    self.build_thread_cache(post)
             else:
                 # removing an entire thread
                 self.delete_thread_cache(post, archiving)
-        elif not recur:
+        elif rebuild and not recur:
             # removing a reply, or a reply's image
             self.build_thread_cache(row.parent)
 
         if admin_data:
             admin_data.contents.append('/%s/%d' % (self.name, int(post)))
 
+        return row.parent or row.num
+
     def delete_file(self, relative_file_path, relative_thumb_path,
                     archiving=False):
         full_file_path = os.path.join(self.path, relative_file_path)
@@ -833,7 +1310,7 @@ class Board(object):
             else:
                 os.unlink(full_file_path)
         if os.path.exists(full_thumb_path) \
-                and re.match(self.options['THUMB_DIR'], relative_file_path):
+                and re.match(self.options['THUMB_DIR'], relative_thumb_path):
             if archiving:
                 os.renames(full_thumb_path, full_tarchive_path)
                 os.chmod(full_tarchive_path, 0644)
@@ -856,6 +1333,7 @@ class Board(object):
             admin_data.contents.append('/%s/%d' % (self.name, int(post)))
 
         # Board pages need refereshing.
+        model.Session().commit()
         self.build_cache()
 
         return staff_interface.StaffInterface(user.login_data.cookie,
@@ -926,6 +1404,8 @@ class Board(object):
                                            admin_post=row.admin_post,
                                            stickied=stickied,
                                            locked=locked)
+            if 'abbreviation' in my_table.c:
+                sql = sql.values(abbreviation=self.abbreviate(row.comment))
             session.execute(sql)
 
             # Move file/thumb.
@@ -937,7 +1417,7 @@ class Board(object):
                     and re.match(self.options['THUMB_DIR'],
                                  row.thumbnail) \
                     and os.path.exists(arch_thumb):
-                os.renames(arch_thumb, os.path.join(self.path, row.thumb))
+                os.renames(arch_thumb, os.path.join(self.path, row.thumbnail))
 
             if not child:
                 if row.parent:
@@ -1106,13 +1586,11 @@ class Board(object):
 
         return Template('edit_successful')
 
-    def process_file(self, filestorage, timestamp, parent, editing):
-        filetypes = self.options.get('EXTRA_FILETYPES', [])
-
-        # analyze file and check that it's in a supported format
-        ext, width, height = misc.analyze_image(filestorage.stream,
-            filestorage.filename)
+    def check_file_type(self, ext, width, height):
+        '''Raises WakaError if files of this type and size can't be posted.
+        Returns whether the type is known (an image or in EXTRA_FILETYPES).'''
 
+        filetypes = self.options.get('EXTRA_FILETYPES', [])
         known = (width != 0 or ext in filetypes)
         if not (self.options['ALLOW_UNKNOWN'] or known) or \
                ext in self.options['FORBIDDEN_EXTENSIONS']:
@@ -1124,48 +1602,43 @@ class Board(object):
                (maxp and (width * height) > maxp):
             raise WakaError(strings.BADFORMAT)
 
-        # generate "random" filename
-        filebase = ("%.3f" % timestamp).replace(".", "")
-        filename = self.make_path(filebase, dirc='IMG_DIR', ext=ext)
+        return known
+
+    def process_file(self, filestorage, timestamp, parent, editing):
+        filetypes = self.options.get('EXTRA_FILETYPES', [])
 
+        # written to disk and checksummed while the request was read
+        upload_file = upload.ingest(filestorage)
 
+        # analyze file and check that it's in a supported format
+        ext, width, height = upload_file.analyze()
+        known = self.check_file_type(ext, width, height)
+        if not width and sniff.is_executable(upload_file.head):
+            raise WakaError(strings.BADFORMAT + " Potential Exploit")
+
+        # generate "random" filename
+        filebase = ("%.3f" % timestamp).replace(".", "")
+        name = "%s.%s" % (filebase, ext.lstrip("."))
         if not known:
-            filename += self.options['MUNGE_UNKNOWN']
+            name += self.options['MUNGE_UNKNOWN']
+        filename = os.path.join(self.path,
+                                self.get_file_path(name, 'IMG_DIR'))
 
-        # copy file
+        # move file into place
         try:
-            filestorage.save(filename)
-        except IOError:
+            util.make_dirs(os.path.dirname(filename))
+            upload_file.save(filename)
+        except (IOError, OSError):
             raise WakaError(strings.NOTWRITE)
 
-        # Check file type with UNIX utility file()
-        file_response = Popen(["file", filename], stdout=PIPE)\
-                        .communicate()[0]
-        if re.match("\:.*(?:script|text|executable)", file_response):
-            os.unlink(filename)
-            raise WakaError(strings.BADFORMAT + " Potential Exploit")
-
-        # Generate thumbnail based on file
-        if file_response.find('JPEG') != -1:
-            thumb_ext = 'jpg'
-        elif file_response.find('GIF') != -1:
-            thumb_ext = 'gif'
-        elif file_response.find('PNG') != -1:
-            thumb_ext = 'png'
+        if width:
+            thumb_ext = thumbnail_backend.get_extension(ext)
         else:
             thumb_ext = os.path.splitext(filename)[1]
-        thumbnail = self.make_path(filebase + "s", dirc='THUMB_DIR',
-                                   ext=thumb_ext)
+        thumbnail = os.path.join(self.path, self.get_file_path(
+            "%ss.%s" % (filebase, thumb_ext.lstrip(".")), 'THUMB_DIR'))
 
-        # get the checksum
-        md5h = hashlib.md5()
-        filestorage.stream.seek(0)
-        while True:
-            buffer = filestorage.stream.read(16 * 1024)
-            if not buffer:
-                break
-            md5h.update(buffer)
-        md5 = md5h.hexdigest()
+        md5 = upload_file.hexdigest()
 
         # check for duplicate files
         if (not editing  and \
@@ -1191,6 +1664,7 @@ class Board(object):
         # do thumbnail
         tn_width = tn_height = 0
         tn_ext = ''
+        deferred = None
 
         if not width:  # unsupported file
             if ext in filetypes: # externally defined filetype
@@ -1234,12 +1708,17 @@ class Board(object):
 
             if self.options['STUPID_THUMBNAILING']:
                 thumbnail = filename
+            elif config.THUMBNAIL_WORKERS:
+                # made once the post is saved
+                deferred = (tn_width, tn_height)
+                tn_width, tn_height = thumbnail_backend.get_size(filename,
+                    tn_width, tn_height)
             else:
                 tn_width, tn_height \
-                    = misc.make_thumbnail(filename, thumbnail, tn_width,
-                        tn_height, self.options['THUMBNAIL_QUALITY'],
+                    = thumbnail_backend.make_thumbnail(filename, thumbnail,
+                        tn_width, tn_height, self.options['THUMBNAIL_QUALITY'],
                         self.options['CONVERT_COMMAND'])
-                if not tn_width and tn_height:
+                if not (tn_width and tn_height):
                     thumbnail = ''
         else:
             tn_width = width
@@ -1251,9 +1730,8 @@ class Board(object):
         if ext in self.options.get('KEEP_NAME_FILETYPES', filetypes):
 
             # cut off any directory in the original filename
-            newfilename = self.make_path(filestorage.filename.split("/")[-1],
-                                         dirc='IMG_DIR', ext=None)
-
+            newfilename = os.path.join(self.path, self.get_file_path(
+                filestorage.filename.split("/")[-1], 'IMG_DIR'))
 
             # verify no name clash
             if not os.path.exists(newfilename):
@@ -1272,7 +1750,11 @@ class Board(object):
 
         # Make file and thumbnail world-readable
         os.chmod(filename, 0644)
-        if thumbnail:
+        if deferred:
+            thumbnail_backend.defer(filename, thumbnail, deferred[0],
+                deferred[1], self.options['THUMBNAIL_QUALITY'],
+                self.options['CONVERT_COMMAND'])
+        elif thumbnail:
             os.chmod(thumbnail, 0644)
 
         # Clear out the board path name.
@@ -1285,6 +1767,12 @@ class Board(object):
         return (filename.encode(sys.getfilesystemencoding()), md5, width,
                 height, thumbnail, tn_width, tn_height)
 
+    def abbreviate(self, comment):
+        '''Returns comment cut down to MAX_LINES_SHOWN lines, or '' if it's
+        short enough'''
+        return abbreviate_html(comment or '', self.options['MAX_LINES_SHOWN'],
+                               self.options['APPROX_LINE_LENGTH']) or ''
+
     def get_reply_link(self, reply, parent='', abbreviated=False,
                        force_http=False):
         if parent:
@@ -1326,6 +1814,16 @@ class Board(object):
         if row:
             return WakaPost(row)
 
+    def get_post_parents(self, nums):
+        '''Returns a dict of post number to parent (0 for threads) for the
+        posts in nums that exist, with a single query'''
+        if not nums:
+            return {}
+        session = model.Session()
+        sql = select([self.table.c.num, self.table.c.parent],
+                     self.table.c.num.in_(nums))
+        return dict([(row.num, row.parent) for row in session.execute(sql)])
+
     def get_parent_post(self, parentid):
         session = model.Session()
         sql = self.table.select(and_(self.table.c.num == parentid,
@@ -1390,8 +1888,9 @@ class Board(object):
                                        table.c.parent == num))\
                             .values(**update)
         session.execute(sql)
+        session.commit()
 
-        self.build_cache()
+        self.build_cache(changed_threads=[int(num)])
 
         task_data.contents.append('/%s/%s' % (self.name, num))
 
@@ -1454,47 +1953,6 @@ class Board(object):
                  pub_date=misc.make_date(time.time(), 'http'))\
                  .render_to_file(rss_file)
 
-    def proxy_check(self, ip):
-        session = model.Session()
-
-        # TODO proxy_clean
-
-        sql = select([func.count()], 'type="black" AND ip=:ip',
-            model.proxy).params(ip=ip)
-        row = session.execute(sql).fetchone()
-        if row and row[0]:
-            raise WakaError(strings.PROXY, plain=True)
-
-        sql = select([func.count()], 'type="white" AND ip=:ip',
-            model.proxy).params(ip=ip)
-        row = session.execute(sql).fetchone()
-        is_white = (row and row[0])
-
-        timestamp = time.time()
-        date = misc.make_date(timestamp, self.options['DATE_STYLE'])
-
-        if is_white:
-            # known good IP, refresh entry
-            sql = model.proxy.update().where(model.proxy.c.ip == ip)\
-                .values(timestamp=timestamp, date=date)
-            session.execute(sql)
-        else:
-            # unknown IP, check for proxy
-
-            # enterprise command launching system
-            # may send crap to stderr on failure
-            retval = os.system(self.options['PROXY_COMMAND'] + " %s" % ip)
-
-            sql = model.proxy.insert().values(ip=ip,
-                timestamp=timestamp, date=date)
-
-            retval_blacklist = self.options.get('PROXY_RETVAL_BLACKLIST', 100)
-            if retval == retval_blacklist:
-                session.execute(sql.values(type='black'))
-                raise WakaError(strings.PROXY, plain=True)
-            else:
-                session.execute(sql.values(type='white'))
-
     def sticky_lock_check(self, wakapost, admin_mode):
         '''Checks for sticky status (or locked) and updates the whole thread
         if it's possible to post there. Raises exception on locked thread.
@@ -1551,6 +2009,20 @@ class Board(object):
                        self.table.c.parent == wakapost.parent))
             .values(lasthit=wakapost.timestamp))
 
+_boards = util.FileCache()
+
+def get_board(name):
+    '''Returns the Board called name, shared by every request in this
+    process until its board_config.py changes. Raises BoardNotFound.'''
+
+    if 'DOCUMENT_ROOT' not in local.environ:
+        local.environ['DOCUMENT_ROOT'] = os.getcwd()
+
+    config_path = os.path.join(local.environ['DOCUMENT_ROOT'],
+                               config.BOARD_DIR, name, 'board_config.py')
+    return _boards.get((local.environ['DOCUMENT_ROOT'], name), config_path,
+                       lambda: Board(name), config.CONFIG_CHECK_INTERVAL)
+
 class NoBoard(object):
     '''Object that provides the minimal attributes to use a few templates
     when no board is defined.'''
@@ -1566,6 +2038,10 @@ class NoBoard(object):
 
 # utility functions
 
+def json_filename(filename):
+    '''Name of the JSON version of a page'''
+    return os.path.splitext(filename)[0] + '.json'
+
 def get_page_count(threads, per_page):
     return (len(threads) + per_page - 1) / per_page
 
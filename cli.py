@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 import inspect
 import werkzeug
 
@@ -30,13 +31,30 @@ def need_environment(f):
 
 @command
 @need_environment
-def rebuild_cache(board_name):
+def rebuild_cache(board_name, jobs=None):
     """
-    $0 rebuild_cache board_name
+    $0 rebuild_cache board_name [--jobs N]
+
+    Builds the thread pages with N processes, REBUILD_JOBS by default.
     """
-    this_board = board.Board(board_name)
+    this_board = board.get_board(board_name)
     local.environ['waka.board'] = this_board
-    this_board.rebuild_cache()
+
+    start = time.time()
+    count = this_board.rebuild_cache(int(jobs or config.REBUILD_JOBS))
+    elapsed = time.time() - start
+
+    print "Rebuilt %d threads in %.1fs (%.1f threads/s)" % (count, elapsed,
+        count / max(elapsed, 0.001))
+
+@command
+@need_environment
+def rebuild_worker():
+    """
+    $0 rebuild_worker
+    """
+    import rebuild_queue
+    rebuild_queue.run_worker()
 
 @command
 @need_environment
@@ -46,7 +64,12 @@ def delete_by_ip(ip, boards):
     """
     boards = boards.split(",")
 
-    interboard.process_global_delete_by_ip(ip, boards)
+    changes = interboard.process_global_delete_by_ip(ip, boards,
+                                                     config.REBUILD_JOBS)
+    for board_name in sorted(changes):
+        threads, pages = changes[board_name]
+        print "/%s/: rebuilt %d threads and %d index pages" % (board_name,
+            len(threads), len(pages))
 
 @command
 @need_environment
@@ -55,7 +78,74 @@ def rebuild_global_cache():
     $0
     """
 
-    interboard.global_cache_rebuild()
+    interboard.global_cache_rebuild(config.REBUILD_JOBS)
+
+@command
+@need_environment
+def update_abbreviations(board_name):
+    """
+    $0 update_abbreviations board_name
+
+    Recomputes the abbreviated comments shown on the index pages, after
+    changing MAX_LINES_SHOWN or APPROX_LINE_LENGTH.
+    """
+    this_board = board.get_board(board_name)
+    local.environ['waka.board'] = this_board
+
+    threads = this_board.update_abbreviations()
+    pages = this_board.build_cache(changed_threads=threads)
+
+    print "Updated posts in %d threads, rebuilt %d index pages" % (
+        len(threads), len(pages))
+
+@command
+@need_environment
+def shard_files(board_name):
+    """
+    $0 shard_files board_name
+
+    Moves images and thumbnails to the subdirectories set by SHARD_DIRS
+    (or out of them), a batch of posts at a time.
+    """
+    this_board = board.get_board(board_name)
+    local.environ['waka.board'] = this_board
+
+    print "Moved %d files" % this_board.shard_files()
+
+@command
+@need_environment
+def create_columns():
+    """
+    $0 create_columns
+
+    Adds the columns that newer versions define to the tables of existing
+    boards.
+    """
+    import model
+
+    for row in interboard.get_all_boards():
+        table = board.get_board(row['board_entry']).options['SQL_TABLE']
+        for name in model.create_board_columns(table):
+            print "Created column %s in %s" % (name, table)
+
+@command
+@need_environment
+def create_indexes():
+    """
+    $0 create_indexes
+
+    Adds missing indexes to the tables of existing boards and to the
+    site-wide tables.
+    """
+    import model
+
+    # load the board tables into the metadata
+    for row in interboard.get_all_boards():
+        board.get_board(row['board_entry'])
+
+    for table in model.metadata.sorted_tables:
+        for name in model.create_indexes(table):
+            print "Created index %s" % name
 
 def reset_password(username):
     """
@@ -95,7 +185,7 @@ def fcgi_tcp(application, host='127.0.0.1', port=9000):
 
     Defaults to listening on 127.0.0.1, port 9000
     """
-    fcgi.WSGIServer(application, bindAddress=(host, int(port))).run()
+    make_fcgi_server(application, bindAddress=(host, int(port))).run()
 
 @command
 @need_application
@@ -103,7 +193,26 @@ def fcgi_unix(application, path):
     """
     $0 fcgi_unix path
     """
-    fcgi.WSGIServer(application, bindAddress=path).run()
+    make_fcgi_server(application, bindAddress=path).run()
+
+def make_fcgi_server(application, **kwargs):
+    """
+    Returns a preforking FastCGI server if FCGI_WORKERS is set, otherwise
+    a threaded one.
+    """
+    if not config.FCGI_WORKERS:
+        return fcgi.WSGIServer(application, **kwargs)
+
+    import model
+    import thumbnail
+
+    def after_fork():
+        # connections opened by the parent can't be shared
+        model.engine.dispose()
+
+    return fcgi.PreforkWSGIServer(application,
+        workers=config.FCGI_WORKERS, maxRequests=config.MAX_FCGI_LOOPS,
+        afterFork=after_fork, beforeExit=thumbnail.wait_deferred, **kwargs)
 
 @command
 def help(command=None):
@@ -158,6 +267,13 @@ def handle_command(args, application):
     name = args.pop(0)
     f = COMMANDS.get(name, help)
 
+    # --name value options become keyword arguments
+    kwargs = {}
+    while '--' in [x[:2] for x in args]:
+        index = [x[:2] for x in args].index('--')
+        option = args.pop(index)[2:].replace('-', '_')
+        kwargs[option] = args.pop(index) if index < len(args) else None
+
     if hasattr(f, 'need_application'):
         args.insert(0, application)
 
@@ -167,10 +283,10 @@ def handle_command(args, application):
 
     try:
         # attempt to call function with specified arguments
-        inspect.getcallargs(f, *args)
+        inspect.getcallargs(f, *args, **kwargs)
     except TypeError:
         # it doesn't fit
         help(name)
         sys.exit(1)
 
-    f(*args)
+    f(*args, **kwargs)
@@ -12,12 +12,16 @@ SQL_STAFFLOG_TABLE = 'staff_activity'
 SQL_COMMON_SITE_TABLE = 'board_index'
 SQL_PASSPROMPT_TABLE = 'passprompt'
 SQL_PASSFAIL_TABLE = 'passfail'
+SQL_REBUILD_QUEUE_TABLE = 'rebuild_queue'
+SQL_COUNTER_TABLE = 'counters'
 USE_TEMPFILES = 1
 DATE_STYLE = 'futaba'
 ERRORLOG = ''
 HOME = '/'
 TIME_OFFSET = 0
 JS_FILE = 'wakaba3.js'
+TEMPLATE_AUTORELOAD = 0
+TEMPLATE_STREAMING = 1
 
 CONVERT_COMMAND = ''
 USE_TEMPFILES = 1
@@ -35,6 +39,16 @@ ALTERNATE_REDIRECT = 0
 SPAM_FILES = ['spam.txt']
 
 MAX_FCGI_LOOPS = 250
+FCGI_WORKERS = 0
+
+REBUILD_QUEUE = 0
+REBUILD_QUEUE_DELAY = 1
+REBUILD_JOBS = 1
+CONFIG_CHECK_INTERVAL = 5
+CHANGED_URLS_FILE = ''
+GZIP_PAGES = 0
+JSON_PAGES = 0
+THREAD_UPDATE_INTERVAL = 0
 
 REPORT_COMMENT_MAX_LENGTH = 250
 REPORT_RENZOKU = 60
@@ -44,6 +58,9 @@ STAFF_LOG_RETENTION = 60*24*3600
 
 PROXY_WHITE_AGE = 14*24*3600
 PROXY_BLACK_AGE = 14*24*3600
+PROXY_CHECK_POLICY = 'wait'
+PROXY_CHECK_THREADS = 4
+PROXY_CHECK_TIMEOUT = 30
 
 POST_BACKUP = 1
 POST_BACKUP_EXPIRE = 3600*24*14
@@ -60,7 +77,8 @@ RSS_WEBMASTER = ''
 BOARD_DIR = ''
 DEBUG = False
 SERVER_NAME = 'localhost'
-IDENTIFY_COMMAND = 'identify'
+THUMBNAIL_BACKEND = 'auto'
+THUMBNAIL_WORKERS = 0
 FG_ANIM_COLOR = 'white'
 BG_ANIM_COLOR = '#660066'
 
@@ -0,0 +1,108 @@
+#!/usr/bin/python2
+'''Shows query plans and timings of the common board queries with and
+without the indexes from model.py. Uses the database from config.py, in a
+scratch board table that is dropped afterwards.
+
+Run from the wakarimasen directory:
+
+    python contrib/bench_indexes.py [threads [replies]]
+'''
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import model
+
+from sqlalchemy.sql import and_, select, func
+
+TABLE_NAME = '__index_bench'
+
+def fill(table, threads, replies):
+    rand = random.Random(1234)
+    now = int(time.time())
+    rows = []
+    num = 0
+    for thread in xrange(threads):
+        num += 1
+        parent = num
+        lasthit = now - rand.randint(0, 30 * 24 * 3600)
+        rows.append(dict(num=num, parent=0, timestamp=lasthit,
+                         lasthit=lasthit, ip=str(rand.randint(0, 2**32)),
+                         md5='%032x' % rand.getrandbits(128),
+                         stickied=int(thread < 3)))
+        for reply in xrange(replies):
+            num += 1
+            rows.append(dict(num=num, parent=parent,
+                             timestamp=lasthit - reply, lasthit=lasthit,
+                             ip=str(rand.randint(0, 2**32)),
+                             md5='%032x' % rand.getrandbits(128),
+                             stickied=0))
+
+    for i in xrange(0, len(rows), 1000):
+        model.engine.execute(table.insert(), rows[i:i + 1000])
+    return num
+
+def queries(table, last):
+    return [
+        ('thread list', select([table.c.num], table.c.parent == 0)
+            .order_by(table.c.stickied.desc(), table.c.lasthit.desc(),
+                      table.c.num.asc())),
+        ('thread page', table.select().where(table.c.parent == last // 2)
+            .order_by(table.c.num.asc())),
+        ('flood check', select([func.count()],
+            and_(table.c.ip == '12345', table.c.timestamp > 0))),
+        ('duplicate image', table.select().where(
+            table.c.md5 == '0123456789abcdef0123456789abcdef')),
+    ]
+
+def to_sql(query):
+    return str(query.compile(dialect=model.engine.dialect,
+                             compile_kwargs={'literal_binds': True}))
+
+def explain(title, table, last, count):
+    print '==', title, '=='
+    if model.engine.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+
+    for name, query in queries(table, last):
+        sql = to_sql(query)
+        plan = model.engine.execute(prefix + sql).fetchall()
+
+        start = time.time()
+        for i in xrange(count):
+            model.engine.execute(sql).fetchall()
+        elapsed = (time.time() - start) * 1000 / count
+
+        print '%-16s %8.2f ms' % (name, elapsed)
+        for row in plan:
+            print '    ' + ' | '.join([str(x) for x in row])
+    print
+
+def main(threads=2000, replies=20, count=20):
+    threads, replies, count = int(threads), int(replies), int(count)
+
+    table = model.board(TABLE_NAME)
+    try:
+        for index in table.indexes:
+            index.drop(bind=model.engine)
+
+        last = fill(table, threads, replies)
+        print '%d posts in %d threads' % (last, threads)
+        print
+
+        explain('without indexes', table, last, count)
+
+        for index in table.indexes:
+            index.create(bind=model.engine)
+        explain('with indexes', table, last, count)
+    finally:
+        table.drop(bind=model.engine, checkfirst=True)
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,155 @@
+#!/usr/bin/python2
+'''Benchmark of the image header sniffers in sniff.py against the
+byte-at-a-time JPEG scanner they replaced, and of GIF frame counting
+against Pillow and ImageMagick's identify (skipped if they aren't
+installed).
+
+Run from the wakarimasen directory (it needs config.py):
+
+    python contrib/bench_sniff.py [count]
+'''
+
+import os
+import sys
+import time
+import struct
+import random
+from cStringIO import StringIO
+from distutils.spawn import find_executable
+from subprocess import Popen, PIPE
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sniff
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+def old_analyze_jpeg(file):
+    '''misc.analyze_jpeg as it was before sniff.py'''
+
+    try:
+        buffer = file.read(2)
+        if buffer != '\xff\xd8':
+            return
+
+        while True:
+            while True:
+                buffer = file.read(1)
+                if not buffer:
+                    return
+                if buffer == '\xff':
+                    break
+
+            mark, size = struct.unpack(">BH", file.read(3))
+
+            if mark in (0xda, 0xd9):
+                break
+
+            if size < 2:
+                raise ValueError("Possible virus in image")
+
+            if mark >= 0xc0 and mark <= 0xc2:
+                bits, height, width = struct.unpack(">BHH", file.read(5))
+                return (width, height)
+
+            file.seek(size - 2, 1)
+    except struct.error:
+        return
+    finally:
+        file.seek(0)
+
+def jpeg_segment(mark, data):
+    return struct.pack('>BBH', 0xff, mark, len(data) + 2) + data
+
+def make_jpeg(app_segments, padding=0):
+    '''A JPEG header: SOI, app_segments APP segments of 60KB each (the
+    size of a big EXIF block or a piece of an ICC profile) followed by
+    padding bytes of garbage, then a frame header'''
+
+    rand = random.Random(1234)
+    segments = [jpeg_segment(0xe0, 'JFIF\0\1\1\0\0\1\0\1\0\0')]
+    for i in xrange(app_segments):
+        # no 0xff, so that nothing looks like a marker
+        data = ''.join([chr(rand.randint(0, 254)) for j in xrange(60000)])
+        segments.append(jpeg_segment(0xe1, data) + '\0' * padding)
+    segments.append(jpeg_segment(0xc0, struct.pack('>BHHB', 8, 1080, 1920, 3)
+                                       + '\1\x22\0\2\x11\1\3\x11\1'))
+    segments.append(jpeg_segment(0xda, '\3\1\0\2\x11\3\x11\0\x3f\0'))
+    return '\xff\xd8' + ''.join(segments) + '\0' * 1000 + '\xff\xd9'
+
+def make_gif(frames):
+    '''An animated GIF with frames frames of 500x375 (only if Pillow is
+    installed)'''
+
+    images = [Image.effect_noise((500, 375), 40 + i).convert('P')
+              for i in xrange(frames)]
+    output = StringIO()
+    images[0].save(output, 'GIF', save_all=True, append_images=images[1:])
+    return output.getvalue()
+
+def bench(name, function, count):
+    start = time.time()
+    for i in xrange(count):
+        function()
+    elapsed = time.time() - start
+    print '%-40s %8.3f ms' % (name, elapsed * 1000 / count)
+
+def main(count=200):
+    count = int(count)
+
+    filename = os.path.join(os.path.dirname(__file__), '__bench')
+    try:
+        for segments, padding in ((0, 0), (1, 0), (4, 0), (4, 4096)):
+            data = make_jpeg(segments, padding)
+            with open(filename, 'wb') as f:
+                f.write(data)
+            name = 'jpeg, %d APP, %d padding' % (segments, padding)
+            assert old_analyze_jpeg(StringIO(data)) == (1920, 1080)
+            assert sniff.analyze(StringIO(data)) == ('jpg', 1920, 1080)
+
+            bench('%s (old)' % name,
+                  lambda: old_analyze_jpeg(StringIO(data)), count)
+            bench('%s (sniff)' % name,
+                  lambda: sniff.analyze(StringIO(data)), count)
+            bench('%s, file (old)' % name,
+                  lambda: old_analyze_jpeg(open(filename, 'rb')), count)
+            bench('%s, file (sniff)' % name,
+                  lambda: sniff.analyze(open(filename, 'rb')), count)
+    finally:
+        os.unlink(filename)
+
+    png = sniff.PNG_MAGIC + struct.pack('>L4sLL', 13, 'IHDR', 640, 480)
+    bench('png (sniff)', lambda: sniff.analyze(StringIO(png)), count)
+
+    if Image is None:
+        print '%-40s  skipped, no Pillow' % 'gif frames'
+        return
+
+    gif = make_gif(10)
+    filename = os.path.join(os.path.dirname(__file__), '__bench.gif')
+    with open(filename, 'wb') as f:
+        f.write(gif)
+    try:
+        bench('gif is animated (sniff)',
+              lambda: sniff.is_animated(filename), count)
+        bench('gif is animated (pillow)',
+              lambda: Image.open(filename).is_animated, count)
+        bench('gif frames (sniff)',
+              lambda: sniff.gif_frames(sniff.Reader(StringIO(gif))), count)
+        bench('gif frames (pillow)',
+              lambda: Image.open(filename).n_frames, count)
+
+        if find_executable('identify'):
+            bench('gif frames (identify)',
+                  lambda: Popen(['identify', '-format', '%n', filename],
+                                stdout=PIPE).communicate(), count // 10)
+        else:
+            print '%-40s  skipped, no ImageMagick' % 'gif frames (identify)'
+    finally:
+        os.unlink(filename)
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,90 @@
+#!/usr/bin/python2
+'''Benchmark of the spam checker with a generated 10k line spam list.
+
+Run from the wakarimasen directory (it needs config.py):
+
+    python contrib/bench_spam.py [lines [checks]]
+'''
+
+import os
+import re
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import misc
+
+def make_spam_file(lines):
+    rand = random.Random(1234)
+    letters = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+    f = tempfile.NamedTemporaryFile(suffix='.txt', delete=False)
+    for i in xrange(lines):
+        word = ''.join([rand.choice(letters)
+                        for x in xrange(rand.randint(6, 20))])
+        if i % 50 == 0:
+            f.write('/%s[0-9]+\\.(com|net)/i\n' % word)
+        elif i % 10 == 0:
+            f.write('%s.com # some comment\n' % word)
+        else:
+            f.write('%s\n' % word)
+    f.close()
+    return f.name
+
+def old_spam_checker(spam_files):
+    '''One regexp per line, as compile_spam_checker used to do'''
+
+    regexps = []
+    for pattern, flags in misc.read_spam_rules(spam_files)[1]:
+        regexps.append(re.compile(pattern, flags))
+    for literal in misc.read_spam_rules(spam_files)[0]:
+        regexps.append(re.compile(re.escape(literal), re.I))
+
+    def spam_checker(string):
+        for regexp in regexps:
+            if regexp.search(string) is not None:
+                return True
+        return False
+
+    return spam_checker
+
+def bench(name, function, count):
+    start = time.time()
+    for i in xrange(count):
+        function()
+    elapsed = time.time() - start
+    print '%-40s %8.2f ms' % (name, elapsed * 1000 / count)
+
+def main(lines=10000, checks=20):
+    lines, checks = int(lines), int(checks)
+    spam_file = make_spam_file(lines)
+    spam_files = [spam_file]
+
+    text = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 40)
+    try:
+        print '%d spam rules, %d characters of text' % (lines, len(text))
+
+        bench('compile (one regexp per rule)',
+              lambda: old_spam_checker(spam_files), 1)
+        bench('compile (combined)',
+              lambda: misc.compile_spam_checker(spam_files), 1)
+
+        old = old_spam_checker(spam_files)
+        bench('check (one regexp per rule)', lambda: old(text), checks)
+
+        new = misc.compile_spam_checker(spam_files)
+        bench('check (combined)', lambda: new(text), checks)
+
+        misc.get_spam_checker(spam_files)
+        bench('cached get_spam_checker + check',
+              lambda: misc.get_spam_checker(spam_files)(text), checks)
+
+        assert not old(text) and not new(text)
+    finally:
+        os.unlink(spam_file)
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,78 @@
+#!/usr/bin/python2
+'''Benchmark of the thumbnail backends with generated JPEG, PNG and animated
+GIF images. Needs Pillow to make the images; ImageMagick is skipped if it
+isn't installed.
+
+Run from the wakarimasen directory (it needs config.py):
+
+    python contrib/bench_thumbnails.py [count]
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from distutils.spawn import find_executable
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import misc
+import thumbnail
+
+from PIL import Image, ImageDraw
+
+def make_images(directory):
+    '''Returns a list of (filename, thumbnail size)'''
+
+    image = Image.new('RGB', (2400, 1800), (240, 240, 230))
+    draw = ImageDraw.Draw(image)
+    for i in xrange(0, 2400, 40):
+        draw.line((i, 0, 2400 - i, 1800), fill=(i % 256, 80, 160), width=7)
+
+    jpeg = os.path.join(directory, 'photo.jpg')
+    image.save(jpeg, quality=90)
+
+    png = os.path.join(directory, 'drawing.png')
+    image.resize((1600, 1200)).save(png)
+
+    frames = [image.resize((500, 375)).rotate(angle).convert('P')
+              for angle in xrange(0, 40, 4)]
+    gif = os.path.join(directory, 'animation.gif')
+    frames[0].save(gif, save_all=True, append_images=frames[1:])
+
+    return [(jpeg, (250, 188)), (png, (250, 188)), (gif, (250, 188))]
+
+def bench(name, function, count):
+    start = time.time()
+    for i in xrange(count):
+        function()
+    elapsed = time.time() - start
+    print '%-40s %8.2f ms' % (name, elapsed * 1000 / count)
+
+def main(count=10):
+    count = int(count)
+    directory = tempfile.mkdtemp()
+    try:
+        images = make_images(directory)
+        convert = find_executable('convert') and find_executable('identify')
+
+        for filename, (width, height) in images:
+            name = os.path.basename(filename)
+            output = os.path.join(directory, 's' + name)
+
+            bench('%s (pillow)' % name,
+                  lambda: thumbnail.make_thumbnail_pillow(filename, output,
+                      width, height, 70), count)
+
+            if convert:
+                bench('%s (convert)' % name,
+                      lambda: misc.make_thumbnail(filename, output,
+                          width, height, 70, 'convert'), count)
+            else:
+                print '%-40s  skipped, no ImageMagick' % ('%s (convert)' % name)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
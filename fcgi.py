@@ -74,7 +74,7 @@ except ImportError:
 if not hasattr(socket, 'SHUT_WR'):
     socket.SHUT_WR = 1
 
-__all__ = ['WSGIServer']
+__all__ = ['WSGIServer', 'PreforkWSGIServer']
 
 # Constants from the spec.
 FCGI_LISTENSOCK_FILENO = 0
@@ -476,6 +476,8 @@ class Record(object):
                 if e[0] == errno.EAGAIN:
                     select.select([sock], [], [])
                     continue
+                elif e[0] == errno.EINTR:
+                    continue
                 else:
                     raise
             if not data: # EOF
@@ -533,6 +535,8 @@ class Record(object):
                 if e[0] == errno.EAGAIN:
                     select.select([], [sock], [])
                     continue
+                elif e[0] == errno.EINTR:
+                    continue
                 else:
                     raise
             data = data[sent:]
@@ -686,6 +690,11 @@ class Connection(object):
                 # Sigh. ValueError gets thrown sometimes when passing select
                 # a closed socket.
                 raise EOFError
+            except select.error, e:
+                # interrupted by a signal
+                if e[0] == errno.EINTR:
+                    continue
+                raise
             if r: break
         if not self._keepGoing:
             return
@@ -1306,6 +1315,225 @@ class WSGIServer(Server):
                                              'required by WSGI!\n' %
                                              (self.__class__.__name__, name))
                 environ[name] = default
+
+
+class PreforkWSGIServer(WSGIServer):
+    """
+    WSGIServer that handles requests in a fixed number of forked worker
+    processes sharing the listening socket, one request at a time each,
+    instead of in threads.
+
+    The parent process only supervises: it restarts workers that exit,
+    either because they crashed or because they handled maxRequests
+    requests. On SIGHUP, every worker finishes its current request and
+    exits, and is replaced by a fresh one once it's gone. SIGINT and
+    SIGTERM stop the workers the same way and then exit.
+    """
+    def __init__(self, application, workers=4, maxRequests=0,
+                 afterFork=None, beforeExit=None, **kw):
+        """
+        workers is the number of worker processes to keep running.
+
+        maxRequests, if non-zero, makes a worker exit (and get replaced)
+        after handling that many requests.
+
+        afterFork, if present, is called with no arguments in each new
+        worker. Use it to drop resources that can't be shared with the
+        parent, like database connections.
+
+        beforeExit, if present, is called with no arguments in a worker
+        that is about to exit normally, for finishing work that its
+        requests left in the background. Workers skip atexit handlers.
+        """
+        kw['multithreaded'] = False
+        super(PreforkWSGIServer, self).__init__(application, **kw)
+
+        self._workers = workers
+        self._maxRequests = maxRequests
+        self._afterFork = afterFork
+        self._beforeExit = beforeExit
+        # one connection at a time, handled inline
+        self._connectionClass = PreforkConnection
+        self.capability = {
+            FCGI_MAX_CONNS: workers,
+            FCGI_MAX_REQS: workers,
+            FCGI_MPXS_CONNS: 0
+            }
+
+        self._children = set()
+        # workers told to stop, which still count until they exit
+        self._retiring = set()
+        self._requestCount = 0
+
+    def _hupHandler(self, signum, frame):
+        self._hupReceived = True
+
+    def run(self, timeout=1.0):
+        """
+        The supervisor loop. Exits on SIGINT or SIGTERM, after the workers
+        are done. Always returns False.
+        """
+        sock = self._setupSocket()
+        # the workers all wait on this socket; only one gets each connection
+        sock.setblocking(0)
+
+        self._keepGoing = True
+        self._hupReceived = False
+
+        self._installSignalHandlers()
+
+        while self._keepGoing:
+            self._reapChildren()
+
+            if self._hupReceived:
+                self._hupReceived = False
+                self._stopChildren(signal.SIGHUP)
+
+            while len(self._children) + len(self._retiring) < self._workers:
+                self._spawnChild(sock)
+
+            try:
+                select.select([], [], [], timeout)
+            except select.error, e:
+                if e[0] != errno.EINTR:
+                    raise
+
+        self._stopChildren(signal.SIGTERM)
+        while True:
+            try:
+                os.wait()
+            except OSError, e:
+                if e[0] == errno.EINTR:
+                    continue
+                if e[0] == errno.ECHILD:
+                    break
+                raise
+
+        self._restoreSignalHandlers()
+
+        self._cleanupSocket(sock)
+
+        return False
+
+    def _reapChildren(self):
+        """Forget about workers that exited."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e[0] == errno.EINTR:
+                    continue
+                if e[0] == errno.ECHILD:
+                    break
+                raise
+            if not pid:
+                break
+            self._children.discard(pid)
+            self._retiring.discard(pid)
+
+    def _stopChildren(self, signum):
+        """Ask the workers to exit after their current request. Each one
+        is replaced once _reapChildren() sees it exit."""
+        for pid in self._children:
+            try:
+                os.kill(pid, signum)
+            except OSError, e:
+                if e[0] != errno.ESRCH:
+                    raise
+        self._retiring.update(self._children)
+        self._children.clear()
+
+    def _spawnChild(self, sock):
+        pid = os.fork()
+        if pid:
+            self._children.add(pid)
+            return
+
+        status = 0
+        try:
+            self._restoreSignalHandlers()
+            for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+                # stop after the current request; system calls that the
+                # signal interrupts are restarted, so the request goes on
+                signal.signal(signum, self._intHandler)
+                signal.siginterrupt(signum, False)
+
+            if self._afterFork is not None:
+                self._afterFork()
+
+            self._childLoop(sock)
+
+            if self._beforeExit is not None:
+                self._beforeExit()
+        except:
+            traceback.print_exc()
+            status = 1
+
+        # don't run the parent's cleanup code
+        os._exit(status)
+
+    def _childLoop(self, sock, timeout=1.0):
+        web_server_addrs = os.environ.get('FCGI_WEB_SERVER_ADDRS')
+        if web_server_addrs is not None:
+            web_server_addrs = map(lambda x: x.strip(),
+                                   web_server_addrs.split(','))
+
+        self._keepGoing = True
+        while self._keepGoing:
+            try:
+                r, w, e = select.select([sock], [], [], timeout)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+
+            if not r:
+                continue
+
+            try:
+                clientSock, addr = sock.accept()
+            except socket.error, e:
+                # another worker got it first
+                if e[0] in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                raise
+
+            if web_server_addrs and \
+                   (len(addr) != 2 or addr[0] not in web_server_addrs):
+                clientSock.close()
+                continue
+
+            clientSock.setblocking(1)
+            conn = self._connectionClass(clientSock, addr, self)
+            conn.run()
+
+            if self._isDone():
+                break
+
+    def _isDone(self):
+        """Whether the worker should exit instead of taking another
+        request."""
+        return not self._keepGoing or \
+               (self._maxRequests and
+                self._requestCount >= self._maxRequests)
+
+    def handler(self, req):
+        self._requestCount += 1
+        return super(PreforkWSGIServer, self).handler(req)
+
+class PreforkConnection(Connection):
+    """
+    Connection of a PreforkWSGIServer worker, which it closes after a
+    request once the worker is done, even if the web server wanted to keep
+    it open.
+    """
+    def end_request(self, req, appStatus=0L,
+                    protocolStatus=FCGI_REQUEST_COMPLETE, remove=True):
+        Connection.end_request(self, req, appStatus, protocolStatus, remove)
+
+        if self._keepGoing and not self._requests and self.server._isDone():
+            self._cleanupSocket()
+            self._keepGoing = False
             
 if __name__ == '__main__':
     def test_app(environ, start_response):
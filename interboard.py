@@ -6,6 +6,7 @@ import re
 import os
 import sys
 import traceback
+import multiprocessing
 from datetime import datetime
 from calendar import timegm
 from subprocess import Popen
@@ -18,6 +19,8 @@ import model
 import util
 import str_format
 import misc
+import ban_index
+import proxy_check
 from template import Template
 from util import WakaError, local
 
@@ -64,29 +67,79 @@ def remove_board_from_index(board_name):
 # Board looping (andwich pattern).
 
 def loop_thru_boards(board_obj_task, exc_msg, *args, **kwargs):
-    try:
-        boards = kwargs.pop('boards')
-    except KeyError:
-        boards = None
+    '''Run a Board method on each board (all of them by default), up to
+    processes boards at a time in worker processes (one at a time in this
+    process by default; more is for the command line). The method returns
+    the numbers of the threads it changed, and only those threads and the
+    index pages showing them are rebuilt; pass rebuild=False for methods
+    that write their own pages. Returns a dict of board name to the
+    (threads, pages) rebuilt, leaving out boards where nothing changed.'''
+
+    boards = kwargs.pop('boards', None)
+    rebuild = kwargs.pop('rebuild', True)
+    processes = kwargs.pop('processes', 1)
 
     if not boards:
         boards = [x['board_entry'] for x in get_all_boards()]
 
-    for board_str in boards:
+    jobs = [(board_str, board_obj_task, exc_msg, args, kwargs, rebuild)
+            for board_str in boards]
+    processes = max(1, min(processes, len(jobs)))
+
+    if processes == 1:
+        results = [_run_board_task(job) for job in jobs]
+    else:
+        # the workers can't share our database connections
+        model.Session().commit()
+        model.Session.remove()
+        model.engine.dispose()
+        sys.stdout.flush()
+
+        pool = multiprocessing.Pool(processes)
         try:
-            board_obj = board.Board(board_str)
-            local.environ['waka.board'] = board_obj
-            getattr(board_obj, board_obj_task)(*args, **kwargs)
-            board_obj.rebuild_cache()
-        except:
-            if exc_msg:
-                sys.stderr.write(exc_msg % board_str + '\n')
-                traceback.print_exc(file=sys.stderr)
+            results = pool.map(_run_board_task, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    return dict([(board_str, result)
+                 for (board_str, result) in zip(boards, results) if result])
+
+def _run_board_task(job):
+    board_str, board_obj_task, exc_msg, args, kwargs, rebuild = job
+
+    session = model.Session()
+    try:
+        board_obj = board.get_board(board_str)
+        local.environ['waka.board'] = board_obj
+        changed = getattr(board_obj, board_obj_task)(*args, **kwargs)
+        # the board lock must not be held while writing to the database
+        session.commit()
+
+        if not rebuild or not changed:
+            return None
+        pages = board_obj.rebuild_threads(changed)
+        return (sorted(changed), pages)
+    except:
+        session.rollback()
+        if exc_msg:
+            sys.stderr.write(exc_msg % board_str + '\n')
+            traceback.print_exc(file=sys.stderr)
+        return None
+    finally:
+        model.Session.remove()
 
 # Global rebuilding
 
-def global_cache_rebuild():
-    loop_thru_boards('rebuild_cache', 'Error in global cache rebuild in %s')
+def global_cache_rebuild(jobs=1):
+    boards = [x['board_entry'] for x in get_all_boards()]
+    # with several boards building at once, one process per board is enough
+    processes = 1
+    if min(jobs, len(boards)) > 1:
+        processes, jobs = jobs, 1
+    loop_thru_boards('rebuild_cache', 'Error in global cache rebuild in %s',
+                     jobs=jobs, boards=boards, rebuild=False,
+                     processes=processes)
 
 def global_cache_rebuild_proxy(task_data):
     if task_data.user.account != staff.ADMIN:
@@ -99,13 +152,13 @@ def global_cache_rebuild_proxy(task_data):
 
 # Global post management.
 
-def process_global_delete_by_ip(ip, boards):
-    loop_thru_boards(
-        'delete_by_ip',
+def process_global_delete_by_ip(ip, boards, processes=1):
+    return loop_thru_boards(
+        'delete_posts_by_ip',
         'Error in deleting posts from %s in %%s' % ip,
-        task_data = None,
         ip = ip,
-        boards = boards
+        boards = boards,
+        processes = processes
     )
 
 # Bans and Whitelists
@@ -169,6 +222,7 @@ def add_admin_entry(task_data, option, comment, ip='', mask='255.255.255.255',
                                 ival2=int(ival2), sval1=sval1, total=total,
                                 expiration=expiration)
     result = session.execute(sql)
+    ban_index.bump_generation()
 
     task_data.admin_id = result.inserted_primary_key[0]
 
@@ -200,6 +254,7 @@ def remove_admin_entry(task_data, num, override_log=False, no_redirect=False):
 
     sql = table.delete().where(table.c.num == num)
     session.execute(sql)
+    ban_index.bump_generation()
     task_data.action = row['type'] + '_remove'
     if string_val:
         task_data.contents.append(row['sval1'])
@@ -218,15 +273,18 @@ def remove_old_bans():
     sql = select([table.c.ival1, table.c.total],
                  and_(table.c.expiration <= time.time(),
                       table.c.expiration != 0))
-    query = session.execute(sql)
+    rows = session.execute(sql).fetchall()
 
-    for row in query:
+    for row in rows:
         sql = table.delete().where(table.c.ival1 == row['ival1'])
         session.execute(sql)
         if row['total']:
             ip = misc.dec_to_dot(row['ival1'])
             remove_htaccess_entry(ip)
 
+    if rows:
+        ban_index.bump_generation()
+
 def remove_old_backups():
     session = model.Session()
     table = model.backup
@@ -235,7 +293,7 @@ def remove_old_backups():
     query = session.execute(sql)
 
     for row in query:
-        board_obj = board.Board(row['board_name'])
+        board_obj = board.get_board(row['board_name'])
         backup_path = os.path.join(board_obj.path,
                                    board_obj.options['ARCHIVE_DIR'],
                                    board_obj.options['BACKUP_DIR'], '')
@@ -309,32 +367,21 @@ def ban_check(numip, name, subject, comment):
     the post contains a forbidden (non-spam) string. It otherwise returns
     nothing.'''
 
-    session = model.Session()
-    table = model.admin
+    index = ban_index.get_index()
 
     # IP Banned?
-    sql = table.select().where(and_(table.c.type == 'ipban',
-                                    table.c.ival1.op('&')(table.c.ival2) \
-                                        == table.c.ival2.op('&')(numip)))
-    ip_row = session.execute(sql).fetchone()
-
-    if ip_row:
+    ban = index.find_ipban(numip)
+    if ban:
         raise WakaError('Address %s banned. Reason: %s' % \
-            (misc.dec_to_dot(numip), ip_row.comment))
+            (misc.dec_to_dot(numip), ban[1]))
 
     # To determine possible string bans, first normalize input to lowercase.
     comment = comment.lower()
     subject = subject.lower()
     name = name.lower()
 
-    sql = select([table.c.sval1], table.c.type == 'wordban')
-    query = session.execute(sql)
-
-    for row in query:
-        bad_string = row.sval1.lower()
-        if comment.count(bad_string) or subject.count(bad_string) or \
-                name.count(bad_string):
-            raise WakaError(strings.STRREF)
+    if index.find_word(comment, subject, name):
+        raise WakaError(strings.STRREF)
 
 def mark_resolved(task_data, delete, posts):
     referer = local.environ['HTTP_REFERER']
@@ -371,7 +418,7 @@ def mark_resolved(task_data, delete, posts):
 
         if delete:
             try:
-                board_obj = board.Board(board_name)
+                board_obj = board.get_board(board_name)
                 local.environ['waka.board'] = board_obj
             except WakaError:
                 errors.append({'error' : '%s,*: Error loading board.'\
@@ -432,6 +479,7 @@ def edit_admin_entry(task_data, num, comment='', ival1=None,
                .values(comment=comment, ival1=ival1, ival2=ival2, sval1=sval1,
                        total=total, expiration=expiration)
     row = session.execute(sql)
+    ban_index.bump_generation()
 
     return Template('edit_successful')
 
@@ -520,9 +568,8 @@ def move_thread(task_data, parent, src_brd_obj, dest_brd_obj):
     # Indicate OP post number after insertion.
     new_parent = 0
 
-    # List of images/thumbs to move around.
-    image_move = []
-    thumb_move = []
+    # List of (old, new) paths of images/thumbs to move around.
+    file_moves = []
 
     lasthit = time.time()
 
@@ -535,10 +582,18 @@ def move_thread(task_data, parent, src_brd_obj, dest_brd_obj):
         image = post['image']
         thumbnail = post['thumbnail']
 
+        # Files get the destination board's directories and layout.
         if image:
-            image_move.append(image)
-        if re.match(src_brd_obj.options['THUMB_DIR'], thumbnail):
-            thumb_move.append(thumbnail)
+            post['image'] = dest_brd_obj.get_file_path(
+                os.path.basename(image), 'IMG_DIR')
+            file_moves.append((image, post['image']))
+        if thumbnail and thumbnail == image:
+            post['thumbnail'] = post['image']
+        elif thumbnail and re.match(src_brd_obj.options['THUMB_DIR'],
+                                    thumbnail):
+            post['thumbnail'] = dest_brd_obj.get_file_path(
+                os.path.basename(thumbnail), 'THUMB_DIR')
+            file_moves.append((thumbnail, post['thumbnail']))
 
         # Update post reference links.
         if new_parent:
@@ -547,40 +602,37 @@ def move_thread(task_data, parent, src_brd_obj, dest_brd_obj):
             new_comment = re.sub(r'a href="(.*?)'
                 + os.path.join(src_brd_obj.path,
                                src_brd_obj.options['RES_DIR'],
-                               '%d%s' % (int(parent)), config.PAGE_EXT),
+                               '%d%s' % (int(parent), config.PAGE_EXT)),
                 r'a href="\1' + os.path.join(\
                                dest_brd_obj.path,
                                dest_brd_obj.options['RES_DIR'],
-                               '%d%s' % (int((new_parent), config.PAGE_EXT))),
+                               '%d%s' % (int(new_parent), config.PAGE_EXT)),
                 post['comment'])
 
             post['comment'] = new_comment
 
-        sql = dest_table.insert().values(**post)
+        post['abbreviation'] = dest_brd_obj.abbreviate(post['comment'])
+
+        sql = dest_table.insert().values(
+            **model.known_values(dest_table, post))
         result = session.execute(sql)
 
         if not new_parent:
             new_parent = result.inserted_primary_key[0]
 
-    # Nested associate for moving files in bulk.
-    def rename_files(filename_list, dir_type):
-        for filename in filename_list:
-            src_filename = os.path.join(src_brd_obj.path, filename)
-            dest_filename = re.sub('^/?' + src_brd_obj.options[dir_type],
-                                   dest_brd_obj.options[dir_type],
-                                   filename)
-            dest_filename = os.path.join(dest_brd_obj.path, dest_filename)
-            os.rename(src_filename, dest_filename)
-
     # File transfer operations.
-    rename_files(image_move, 'IMG_DIR')
-    rename_files(thumb_move, 'THUMB_DIR')
-
-    dest_brd_obj.build_cache()
-    dest_brd_obj.build_thread_cache(new_parent)
+    for src_filename, dest_filename in file_moves:
+        src_filename = os.path.join(src_brd_obj.path, src_filename)
+        dest_filename = os.path.join(dest_brd_obj.path, dest_filename)
+        util.make_dirs(os.path.dirname(dest_filename))
+        os.rename(src_filename, dest_filename)
 
+    # commits the copy along with the deletion
     src_brd_obj.delete_stuff([parent], '', False, False, caller='internal')
 
+    dest_brd_obj.build_cache(changed_threads=[new_parent])
+    dest_brd_obj.build_thread_cache(new_parent)
+
     forward_url = misc.make_script_url(task='mpanel',
         board=dest_brd_obj.name, page=('t%s' % new_parent))
 
@@ -616,6 +668,8 @@ def add_proxy_entry(task_data, type, ip, timestamp):
     )
     session.execute(query)
 
+    proxy_check.forget()
+
     board = local.environ['waka.board']
     forward_url = misc.make_script_url(task='proxy', board=board.name)
 
@@ -628,6 +682,8 @@ def remove_proxy_entry(task_data, num):
     query = table.delete().where(table.c.num == num)
     session.execute(query)
 
+    proxy_check.forget()
+
     board = local.environ['waka.board']
     forward_url = misc.make_script_url(task='proxy', board=board.name)
 
@@ -4,10 +4,11 @@ import re
 import time
 import crypt
 import struct
-from subprocess import Popen, PIPE
+from subprocess import Popen
 
 import util
 import crypto  # part of wakarimasen
+import sniff
 import config, config_defaults
 import str_format
 import urllib
@@ -97,9 +98,16 @@ def hide_critical_data(string, key):
         i += 15
     return ret
 
-def compile_spam_checker(spam_files):
-    # TODO caching this by timestamps would be nice
-    regexps = []
+SPAM_BACKREF_RE = re.compile(r'\\[1-9]|\(\?P=')
+
+_spam_checkers = {}
+
+def read_spam_rules(spam_files):
+    '''Returns the literal strings and (pattern, flags) regexp rules found
+    in the spam files'''
+
+    literals = []
+    rules = []
     for file in spam_files:
         for line in open(file).readlines():
             line = re.sub("(^|\s+)#.*", "", line).strip()
@@ -110,10 +118,77 @@ def compile_spam_checker(spam_files):
             if match:
                 pattern, modifiers = match.groups()
                 flags = sum([getattr(re, x.upper()) for x in modifiers])
+                rules.append((pattern, flags))
             else:
-                pattern = re.escape(line)
-                flags = re.I
+                literals.append(line)
+    return literals, rules
+
+def make_literal_pattern(literals):
+    '''Builds a single case-insensitive regexp matching any of the given
+    strings. Common prefixes are factored out into a trie, so matching
+    doesn't try every string at every position of the text.'''
+
+    trie = {}
+    for literal in literals:
+        node = trie
+        for char in literal.lower():
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        if '' in node:
+            # a complete literal ends here, so longer ones can't add matches
+            return ''
+
+        branches = []
+        for char in sorted(node):
+            # follow chains without branches as a single literal run
+            run = char
+            child = node[char]
+            while len(child) == 1 and '' not in child:
+                next_char = child.keys()[0]
+                run += next_char
+                child = child[next_char]
+            branches.append(re.escape(run) + build(child))
+
+        if len(branches) == 1:
+            return branches[0]
+        return '(?:%s)' % '|'.join(branches)
+
+    if not trie:
+        return None
+    return re.compile(build(trie), re.I)
+
+def combine_spam_rules(rules):
+    '''Joins regexp rules with the same flags into one pattern each.
+    Rules with backreferences keep their own pattern, since combining
+    would renumber their groups.'''
+
+    by_flags = {}
+    regexps = []
+    for pattern, flags in rules:
+        if SPAM_BACKREF_RE.search(pattern):
             regexps.append(re.compile(pattern, flags))
+        else:
+            by_flags.setdefault(flags, []).append(pattern)
+
+    for flags, patterns in sorted(by_flags.items()):
+        try:
+            regexps.append(re.compile(
+                '|'.join(['(?:%s)' % x for x in patterns]), flags))
+        except (re.error, AssertionError, OverflowError):
+            # too many groups for one pattern, or a rule that can't be
+            # wrapped. Fall back to one pattern per rule.
+            regexps.extend([re.compile(x, flags) for x in patterns])
+    return regexps
+
+def compile_spam_checker(spam_files):
+    literals, rules = read_spam_rules(spam_files)
+
+    regexps = combine_spam_rules(rules)
+    literal_regexp = make_literal_pattern(literals)
+    if literal_regexp is not None:
+        regexps.insert(0, literal_regexp)
 
     def spam_checker(string):
         for regexp in regexps:
@@ -123,6 +198,21 @@ def compile_spam_checker(spam_files):
 
     return spam_checker
 
+def get_spam_checker(spam_files):
+    '''Returns the compiled checker for the spam files, compiling it again
+    only if one of them was modified since the last call'''
+
+    spam_files = tuple(spam_files)
+    mtimes = tuple([os.path.getmtime(x) for x in spam_files])
+
+    cached = _spam_checkers.get(spam_files)
+    if cached is not None and cached[0] == mtimes:
+        return cached[1]
+
+    spam_checker = compile_spam_checker(spam_files)
+    _spam_checkers[spam_files] = (mtimes, spam_checker)
+    return spam_checker
+
 def spam_engine(trap_fields, spam_files):
     def spam_screen():
         raise util.SpamError()
@@ -132,7 +222,7 @@ def spam_engine(trap_fields, spam_files):
         if request.values.get('request', None) is not None:
             spam_screen()
 
-    spam_checker = compile_spam_checker(spam_files)
+    spam_checker = get_spam_checker(spam_files)
     fields = request.values.keys()
 
     fulltext = '\n'.join([str_format.decode_string(request.values[x])
@@ -249,11 +339,12 @@ def get_filestorage_size(filestorage):
     return size
 
 def analyze_image(file, name):
-    types = [("jpg", analyze_jpeg), ("png", analyze_png), ("gif", analyze_gif)]
-    for ext, analyze in types:
-        res = analyze(file)
-        if res:
-            return (ext, res[0], res[1])
+    try:
+        res = sniff.analyze(file)
+    finally:
+        file.seek(0)
+    if res:
+        return res
 
     # find file extension for unknown files
     ext = ''
@@ -261,66 +352,6 @@ def analyze_image(file, name):
         ext = name.split(".")[-1].lower()
     return (ext, 0, 0)
 
-def analyze_jpeg(file):
-    # TODO: requires testing
-    try:
-        buffer = file.read(2)
-        if buffer != '\xff\xd8':
-            return
-
-        while True:
-            while True:
-                buffer = file.read(1)
-                if not buffer:
-                    return
-                if buffer == '\xff':
-                    break
-
-            mark, size = struct.unpack(">BH", file.read(3))
-
-            if mark in (0xda, 0xd9): # SOS/EOI
-                break
-
-            if size < 2:
-                # MS GDI+ JPEG exploit uses short chunks
-                raise util.WakaError("Possible virus in image")
-
-            if mark >= 0xc0 and mark <= 0xc2: # SOF0..SOF2 - what the hell are the rest?
-                bits, height, width = struct.unpack(">BHH", file.read(5))
-                return (width, height)
-
-            file.seek(size - 2, 1)
-    except struct.error:
-        return
-    finally:
-        file.seek(0)
-
-PNG_MAGIC = '\x89PNG\r\n\x1a\n'
-PNG_IHDR = 'IHDR'
-
-def analyze_png(file):
-    buffer = file.read(24)
-    file.seek(0)
-    if len(buffer) != 24:
-        return
-
-    magic, length, ihdr, width, height = struct.unpack(">8sL4sLL", buffer)
-    if magic != PNG_MAGIC and ihdr != PNG_IHDR:
-        return
-    return (width, height)
-
-GIF_MAGICS = ('GIF87a', 'GIF89a')
-def analyze_gif(file):
-    buffer = file.read(10)
-    file.seek(0)
-    if len(buffer) != 10:
-        return
-
-    magic, width, height = struct.unpack('<6sHH', buffer)
-    if magic not in GIF_MAGICS:
-        return
-    return (width, height)
-
 def make_thumbnail(filename, thumbnail, width, height, quality, convert):
     is_animated = False
     magickname = filename
@@ -328,16 +359,9 @@ def make_thumbnail(filename, thumbnail, width, height, quality, convert):
     popen_array = [convert, '-resize', '%sx%s!' % (width, height),
                    '-quality', str(quality)]
 
-    if magickname.endswith(".gif"):
-        identify = config.IDENTIFY_COMMAND
-        gif_check = Popen([identify, '-format', '%n', magickname],
-                          stdout=PIPE).communicate()[0]
-        try:
-            if int(gif_check) > 1:
-                magickname += '[0]'
-                is_animated = True
-        except ValueError:
-            pass
+    if sniff.is_animated(filename):
+        magickname += '[0]'
+        is_animated = True
 
     if is_animated:
         popen_array.extend([magickname, '-background', config.BG_ANIM_COLOR,
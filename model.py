@@ -1,11 +1,12 @@
 import config, config_defaults
 from sqlalchemy import create_engine
-from sqlalchemy import Table, Column, Integer, Text, String, MetaData
+from sqlalchemy import Table, Column, Index, Integer, Text, String, MetaData
+from sqlalchemy.engine import reflection
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.sql import func
+from sqlalchemy.sql import select, func
 
 # needed by other modules
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import OperationalError, IntegrityError
 
 pool_opts = {}
 
@@ -22,12 +23,9 @@ metadata = MetaData()
 
 _boards = {}
 
-def board(name):
-    '''Generates board table objects'''
-    if name in _boards:
-        return _boards[name]
-
-    table = Table(name, metadata,
+def board_columns():
+    '''New Column objects for a board table'''
+    return [
         Column("num", Integer, primary_key=True),       # Post number, auto-increments
         Column("parent", Integer),                      # Parent post for replies in threads. For original posts, must be set to 0 (and not null)
         Column("timestamp", Integer),                   # Timestamp in seconds for when the post was created
@@ -55,10 +53,37 @@ def board(name):
         Column("admin_post", Text),                  # ADDED - Admin post?
         # TODO: Probably should make this Boolean. Keeping as int for now to maintain compatibility with sorting functions.
         Column("stickied", Integer),                    # ADDED - Stickied?
-        Column("locked", Text)                          # ADDED - Locked?
-    )
+        Column("locked", Text),                         # ADDED - Locked?
+        Column("abbreviation", Text(convert_unicode=True)), # Comment cut down for index pages, '' if it fits or NULL if not computed yet
+    ]
+
+def board(name):
+    '''Generates board table objects. Columns that newer versions added
+    are left out if the table doesn't have them yet; the create_columns
+    command adds them.'''
+    if name in _boards:
+        return _boards[name]
+
+    columns = board_columns()
+    if engine.has_table(name):
+        inspector = reflection.Inspector.from_engine(engine)
+        existing = set([x['name'] for x in inspector.get_columns(name)])
+        columns = [x for x in columns if x.name in existing]
+
+    table = Table(name, metadata, *columns)
+
+    # thread lists and thread pages
+    Index('ix_%s_parent_stickied_lasthit' % name,
+          table.c.parent, table.c.stickied, table.c.lasthit)
+    Index('ix_%s_parent_num' % name, table.c.parent, table.c.num)
+    # flood checks and deleting by ip
+    Index('ix_%s_ip_timestamp' % name, table.c.ip, table.c.timestamp,
+          mysql_length={'ip': 20})
+    # duplicate image detection
+    Index('ix_%s_md5' % name, table.c.md5, mysql_length=32)
 
     table.create(bind=engine, checkfirst=True)
+
     _boards[name] = table
     return _boards[name]
 
@@ -81,6 +106,7 @@ proxy = Table(config.SQL_PROXY_TABLE, metadata,
     Column("timestamp", Integer),                       # Age since epoch
     Column("date", Text)                                # Human-readable form of date 
 )
+Index('ix_%s_ip' % proxy.name, proxy.c.ip, mysql_length=40)
 
 account = Table(config.SQL_ACCOUNT_TABLE, metadata,
     Column("username", String(25), primary_key=True),   # Name of user--must be unique
@@ -100,6 +126,7 @@ activity = Table(config.SQL_STAFFLOG_TABLE, metadata,
     Column("admin_id", Integer),                        # For associating certain entries with the corresponding key on the admin table
     Column("timestamp", Integer)                        # Timestamp, for trimming
 )
+Index('ix_%s_timestamp' % activity.name, activity.c.timestamp)
 
 common = Table(config.SQL_COMMON_SITE_TABLE, metadata,
     Column("board", String(25), primary_key=True),      # Name of comment table
@@ -118,6 +145,10 @@ report = Table(config.SQL_REPORT_TABLE, metadata,
     Column("date", Text),                               # Date of the report
     Column("resolved", Integer)                         # Is it resolved? (1: yes 0: no)
 )
+Index('ix_%s_board_resolved' % report.name, report.c.board, report.c.resolved)
+Index('ix_%s_board_postnum' % report.name, report.c.board, report.c.postnum)
+Index('ix_%s_reporter_timestamp' % report.name, report.c.reporter,
+      report.c.timestamp, mysql_length={'reporter': 20})
 
 backup = Table(config.SQL_BACKUP_TABLE, metadata,
     Column("num", Integer, primary_key=True),           # Primary key, auto-increments
@@ -151,6 +182,12 @@ backup = Table(config.SQL_BACKUP_TABLE, metadata,
     Column("locked", Text),                             # ADDED - Locked?
     Column("timestampofarchival", Integer)              # When was this backed up?
 )
+Index('ix_%s_board_name_postnum' % backup.name,
+      backup.c.board_name, backup.c.postnum)
+Index('ix_%s_board_name_parent' % backup.name,
+      backup.c.board_name, backup.c.parent)
+Index('ix_%s_timestampofarchival' % backup.name,
+      backup.c.timestampofarchival)
 
 passprompt = Table(config.SQL_PASSPROMPT_TABLE, metadata,
     Column("id", Integer, primary_key=True),
@@ -162,6 +199,105 @@ passprompt = Table(config.SQL_PASSPROMPT_TABLE, metadata,
     Column("passfail", Integer) 
 )
 
+rebuild_queue = Table(config.SQL_REBUILD_QUEUE_TABLE, metadata,
+    Column("num", Integer, primary_key=True),           # Job number, auto-increments
+    Column("board", String(25), nullable=False),        # Board name
+    Column("thread", Integer, nullable=False),          # Thread whose index pages to rebuild
+    Column("timestamp", Integer)                        # When the job was queued
+)
+# one waiting job per thread
+Index('ux_%s_board_thread' % rebuild_queue.name,
+      rebuild_queue.c.board, rebuild_queue.c.thread, unique=True)
+
+counter = Table(config.SQL_COUNTER_TABLE, metadata,
+    Column("name", String(25), primary_key=True),       # Name of the counter
+    Column("value", Integer, nullable=False)            # Current value
+)
+
+def create_indexes(table):
+    '''Adds the indexes defined for a table that the database doesn't have
+    yet, for tables created by older versions. Returns their names.'''
+
+    inspector = reflection.Inspector.from_engine(engine)
+    existing = set([x['name'] for x in inspector.get_indexes(table.name)])
+
+    created = []
+    for index in sorted(table.indexes, key=lambda x: x.name):
+        if index.name not in existing:
+            index.create(bind=engine)
+            created.append(index.name)
+    return created
+
+def create_board_columns(name):
+    '''Adds the board table columns that the database doesn't have yet,
+    for tables created by older versions. Returns their names.'''
+
+    # a table object of its own, since board() leaves these columns out
+    return create_columns(Table(name, MetaData(), *board_columns()))
+
+def create_columns(table):
+    '''Adds the columns defined for a table that the database doesn't have
+    yet, for tables created by older versions. Returns their names.'''
+
+    inspector = reflection.Inspector.from_engine(engine)
+    existing = set([x['name'] for x in inspector.get_columns(table.name)])
+    preparer = engine.dialect.identifier_preparer
+
+    created = []
+    for column in table.columns:
+        if column.name not in existing:
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                preparer.format_table(table), preparer.format_column(column),
+                column.type.compile(dialect=engine.dialect)))
+            created.append(column.name)
+    return created
+
+def get_counter(name):
+    '''Value of a counter in the counter table, 0 if it was never bumped'''
+
+    session = Session()
+    sql = select([counter.c.value], counter.c.name == name)
+    row = session.execute(sql).fetchone()
+    return row[0] if row else 0
+
+def bump_counter(name):
+    '''Increments a counter. Takes effect when the caller commits.'''
+
+    session = Session()
+    sql = counter.update().where(counter.c.name == name)\
+                 .values(value=counter.c.value + 1)
+    if not session.execute(sql).rowcount:
+        session.execute(counter.insert().values(name=name, value=1))
+
+def known_values(table, values):
+    '''values without the ones for columns that table doesn't have (yet)'''
+    return dict([(key, value) for (key, value) in values.iteritems()
+                 if key in table.c])
+
+# INSERT variants that skip rows clashing with a unique key
+INSERT_IGNORE_PREFIXES = {
+    'sqlite': 'OR IGNORE',
+    'mysql': 'IGNORE',
+}
+
+def insert_ignore(session, table, **values):
+    '''Inserts a row into table, unless one with the same unique key is
+    already there. Doesn't commit.'''
+
+    sql = table.insert().values(**values)
+    prefix = INSERT_IGNORE_PREFIXES.get(engine.dialect.name)
+    if prefix:
+        session.execute(sql.prefix_with(prefix))
+        return
+
+    savepoint = session.begin_nested()
+    try:
+        session.execute(sql)
+    except IntegrityError:
+        savepoint.rollback()
+    else:
+        savepoint.commit()
+
 class Page(object):
     '''Pagination class: Given an SQL query and pagination information,
     produce only the relevant rows. N.B.: The board.Board class uses
@@ -0,0 +1,138 @@
+'''Rendered posts, kept so that building a page only has to render the posts
+that changed since the last build. Each fragment is stored along with a
+digest of the post and of everything else it was rendered from, and is
+thrown away when that doesn't match anymore: edits, deletions, sticky and
+lock changes all change the post, so there's nothing to bump by hand.
+
+Fragments of public pages are saved in a file per thread, under FRAGMENT_DIR.
+Staff pages show IP addresses and are kept in memory instead.'''
+
+import os
+import marshal
+import hashlib
+import threading
+
+import config
+import strings
+
+FRAGMENT_DIR = os.path.join('templates', '.cache', 'posts')
+
+# Number of staff page fragments kept in memory by each process
+MEMORY_STORE_SIZE = 5000
+
+# Post attributes the fragments are rendered from. lasthit and password
+# are left out, since they don't show up and lasthit changes all the time.
+STAMP_FIELDS = ('num', 'parent', 'timestamp', 'ip', 'date', 'name', 'trip',
+                'email', 'subject', 'comment', 'image', 'size', 'md5',
+                'width', 'height', 'thumbnail', 'tn_width', 'tn_height',
+                'lastedit', 'lastedit_ip', 'admin_post', 'stickied', 'locked',
+                'abbrev')
+
+def _mtime(filename):
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
+
+def get_version(board, template_file, environ):
+    '''Digest of what the fragments of a board depend on besides the posts
+    themselves: the template, the configuration and the URLs'''
+
+    files = [template_file, os.path.join(board.path, 'board_config.py'),
+             config.__file__, strings.__file__]
+    return hashlib.md5(repr((
+        [_mtime(filename) for filename in files],
+        environ.get('SCRIPT_NAME'), board.url,
+    ))).hexdigest()
+
+def get_stamp(post, version):
+    '''Digest of everything a post fragment is rendered from'''
+
+    values = [getattr(post, field) for field in STAMP_FIELDS]
+    return hashlib.md5(repr((version, values))).hexdigest()
+
+class DiskStore(object):
+    '''Fragments of a board's public pages, in a file per thread. Changes
+    are written by save(); when several processes save the same thread at
+    once, the last one wins and the others' fragments are rendered again
+    next time.'''
+
+    def __init__(self, board):
+        self.path = os.path.join(FRAGMENT_DIR, board.name)
+        self.threads = {}       # thread -> {key: (stamp, utf-8 html)}
+        self.changed = set()
+
+    def _load(self, thread):
+        if thread not in self.threads:
+            # marshal, because it loads about ten times faster than json
+            try:
+                with open(self._filename(thread), 'rb') as f:
+                    self.threads[thread] = marshal.load(f)
+            except (IOError, EOFError, ValueError, TypeError):
+                self.threads[thread] = {}
+        return self.threads[thread]
+
+    def _filename(self, thread):
+        return os.path.join(self.path, '%d.cache' % thread)
+
+    def get(self, thread, key, stamp):
+        entry = self._load(thread).get(key)
+        if entry is not None and entry[0] == stamp:
+            return entry[1].decode('utf-8')
+        return None
+
+    def put(self, thread, key, stamp, html):
+        self._load(thread)[key] = (stamp, html.encode('utf-8'))
+        self.changed.add(thread)
+
+    def save(self):
+        if self.changed and not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # made by someone else in the meantime
+                pass
+
+        for thread in self.changed:
+            filename = self._filename(thread)
+            tempname = filename + '.tmp%d.%d' % (os.getpid(),
+                                                 threading.current_thread().ident)
+            with open(tempname, 'wb') as f:
+                marshal.dump(self.threads[thread], f)
+            os.rename(tempname, filename)
+        self.changed.clear()
+
+def forget_thread(board, thread):
+    '''Delete the saved fragments of a thread'''
+
+    filename = os.path.join(FRAGMENT_DIR, board.name,
+                            '%d.cache' % int(thread))
+    if os.path.exists(filename):
+        os.unlink(filename)
+
+class MemoryStore(object):
+    '''Fragments kept in memory, shared by every request in the process'''
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, thread, key, stamp):
+        with self.lock:
+            entry = self.entries.get((thread, key))
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        return None
+
+    def put(self, thread, key, stamp, html):
+        with self.lock:
+            if len(self.entries) >= self.size:
+                # start over rather than keeping track of what's oldest
+                self.entries.clear()
+            self.entries[(thread, key)] = (stamp, html)
+
+    def save(self):
+        pass
+
+staff_store = MemoryStore(MEMORY_STORE_SIZE)
@@ -0,0 +1,220 @@
+'''Open proxy detection. Verdicts are kept in the proxy table and cached in
+memory until they expire (PROXY_WHITE_AGE / PROXY_BLACK_AGE). Unknown IPs
+are queued and scanned with the board's PROXY_COMMAND by
+PROXY_CHECK_THREADS worker threads per process; PROXY_CHECK_POLICY decides
+whether the poster waits for the scan ('wait') or is let through while it
+runs in the background ('provisional').
+
+Each process drops its cache when the generation counter in the database
+says that staff edited the proxy table.'''
+
+import os
+import sys
+import time
+import errno
+import signal
+import Queue
+import threading
+import traceback
+from collections import OrderedDict
+from subprocess import Popen
+
+import config
+import model
+import misc
+import strings
+from util import WakaError
+
+from sqlalchemy.sql import select
+
+WHITE = 'white'
+BLACK = 'black'
+
+GENERATION = 'proxies'
+
+# Verdicts kept in memory per process. The least recently used ones are
+# dropped beyond this.
+CACHE_SIZE = 10000
+
+_cache = OrderedDict()  # ip -> (type, expiration), least recently used first
+_generation = None
+_pending = {}           # ip -> threading.Event set when the scan is done
+_lock = threading.Lock()
+_queue = None
+
+def _get_queue():
+    '''The queue of pending scans, started along with its worker threads on
+    first use'''
+
+    global _queue
+    with _lock:
+        if _queue is None:
+            _queue = Queue.Queue()
+            for i in xrange(config.PROXY_CHECK_THREADS):
+                worker = threading.Thread(target=_work, args=(_queue,))
+                # a scan left running at exit is simply redone later
+                worker.daemon = True
+                worker.start()
+        return _queue
+
+def _work(queue):
+    while True:
+        job = queue.get()
+        try:
+            _scan(*job)
+        finally:
+            queue.task_done()
+
+def _age(type):
+    return config.PROXY_WHITE_AGE if type == WHITE else config.PROXY_BLACK_AGE
+
+def check(ip, options):
+    '''Raises WakaError if ip is a known or newly detected open proxy'''
+
+    verdict = lookup(ip)
+    if verdict is None:
+        event = _start_scan(ip, options)
+        if config.PROXY_CHECK_POLICY != 'provisional':
+            # give up a bit after the scan itself would have timed out,
+            # in case it's still waiting in the queue
+            event.wait(config.PROXY_CHECK_TIMEOUT * 2)
+            verdict = lookup(ip)
+
+    if verdict == BLACK:
+        raise WakaError(strings.PROXY, plain=True)
+
+def lookup(ip):
+    '''Returns 'black', 'white' or None if there is no current verdict'''
+
+    global _generation
+
+    now = time.time()
+    generation = model.get_counter(GENERATION)
+    with _lock:
+        if generation != _generation:
+            _cache.clear()
+            _generation = generation
+
+        entry = _cache.pop(ip, None)
+        if entry is not None and entry[1] > now:
+            _cache[ip] = entry
+            return entry[0]
+
+    session = model.Session()
+    table = model.proxy
+    sql = select([table.c.type, table.c.timestamp], table.c.ip == ip)
+
+    verdict = None
+    for row in session.execute(sql):
+        expiration = int(row.timestamp or 0) + _age(row.type)
+        if expiration <= now:
+            continue
+        if row.type == BLACK or verdict is None:
+            verdict = row.type
+            _remember(ip, row.type, expiration)
+        if verdict == BLACK:
+            break
+
+    return verdict
+
+def _remember(ip, type, expiration):
+    with _lock:
+        _cache.pop(ip, None)
+        _cache[ip] = (type, expiration)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def forget():
+    '''Make every process drop its cached verdicts. Call it in the same
+    transaction as an edit of the proxy table.'''
+
+    global _generation
+
+    model.bump_counter(GENERATION)
+    with _lock:
+        _cache.clear()
+        _generation = None
+
+def record(ip, type, timestamp):
+    '''Store a verdict, replacing any older entry for the ip'''
+
+    date = misc.make_date(timestamp, style=config.DATE_STYLE)
+
+    session = model.Session()
+    table = model.proxy
+    session.execute(table.delete().where(table.c.ip == ip))
+    session.execute(table.insert().values(type=type, ip=ip,
+                                          timestamp=timestamp, date=date))
+    session.commit()
+
+def _start_scan(ip, options):
+    '''Returns an event that is set when the scan of ip is finished. Only
+    one scan per ip runs at a time.'''
+
+    with _lock:
+        event = _pending.get(ip)
+        if event is not None:
+            return event
+        event = _pending[ip] = threading.Event()
+
+    command = options['PROXY_COMMAND'] + " %s" % ip
+    blacklist = options.get('PROXY_RETVAL_BLACKLIST', 100)
+
+    _get_queue().put((ip, command, blacklist, event))
+    return event
+
+def _scan(ip, command, blacklist, event):
+    try:
+        retval = run_command(command, config.PROXY_CHECK_TIMEOUT)
+        if retval is None:
+            # timed out: let the post through without a verdict, so that
+            # the ip is scanned again next time
+            sys.stderr.write('Proxy check of %s timed out\n' % ip)
+            return
+
+        type = BLACK if retval == blacklist else WHITE
+        timestamp = time.time()
+
+        # let waiting posters see the verdict before writing it, since
+        # their transactions may be holding locks on the database
+        _remember(ip, type, timestamp + _age(type))
+        event.set()
+
+        record(ip, type, timestamp)
+    except:
+        sys.stderr.write('Error while checking %s for proxies\n' % ip)
+        traceback.print_exc(file=sys.stderr)
+    finally:
+        model.Session.remove()
+        with _lock:
+            del _pending[ip]
+        event.set()
+
+def run_command(command, timeout):
+    '''Runs a shell command, killing it and everything it started after
+    timeout seconds. Returns its exit code, or None if it had to be
+    killed.'''
+
+    # enterprise command launching system
+    # may send crap to stderr on failure
+    # in a process group of its own, so that the scanner the shell started
+    # is killed along with it
+    process = Popen(command, shell=True, preexec_fn=os.setpgrp)
+    timer = threading.Timer(timeout, _kill_group, args=(process.pid,))
+    timer.start()
+    try:
+        retval = process.wait()
+    finally:
+        timer.cancel()
+
+    if retval < 0:
+        return None
+    return retval
+
+def _kill_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError as e:
+        # already gone
+        if e.errno != errno.ESRCH:
+            raise
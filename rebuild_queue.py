@@ -0,0 +1,144 @@
+'''Queue of pending index page rebuilds, so that posting doesn't have to
+wait for them. Thread pages are still built by whoever changed the thread.
+Jobs are stored in the database and processed by a worker process, which
+is started on demand.'''
+
+import os
+import sys
+import time
+import fcntl
+import traceback
+from subprocess import Popen
+
+import config
+import model
+import util
+import board
+from util import local
+
+from sqlalchemy.sql import select, func
+
+LOCK_FILE = os.path.join(os.getcwd(), '.rebuild_queue.lock')
+
+def queue_rebuild(board_obj, threads):
+    '''Queue a rebuild of the index pages of a board that show the given
+    threads, as part of the caller's transaction. Jobs already waiting in
+    the queue are not added twice. The worker is started by start_worker()
+    once the jobs are committed.'''
+
+    session = model.Session()
+    for thread in set(threads):
+        model.insert_ignore(session, model.rebuild_queue,
+                            board=board_obj.name, thread=thread,
+                            timestamp=time.time())
+
+    local.environ['waka.rebuild_queued'] = True
+
+def start_worker():
+    '''Start a worker for the jobs queued in this request, if there were
+    any and none is running. Call it after committing.'''
+
+    if not local.environ.pop('waka.rebuild_queued', False):
+        return
+
+    if not worker_running():
+        Popen([sys.executable, sys.argv[0], 'rebuild_worker'],
+            env=util.proxy_environ())
+
+def _lock(blocking=False):
+    '''Returns the open worker lock file, or None if another process
+    holds it'''
+
+    lockfile = open(LOCK_FILE, 'a')
+    flags = fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(lockfile, flags)
+    except IOError:
+        lockfile.close()
+        return None
+    return lockfile
+
+def worker_running():
+    lockfile = _lock()
+    if lockfile is None:
+        return True
+    lockfile.close()
+    return False
+
+def has_jobs():
+    session = model.Session()
+    sql = select([func.count()], from_obj=[model.rebuild_queue])
+    try:
+        return session.execute(sql).fetchone()[0] != 0
+    finally:
+        # don't keep the snapshot for the next check
+        session.rollback()
+
+def run_worker():
+    '''Process jobs until the queue stays empty for REBUILD_QUEUE_DELAY
+    seconds. Returns immediately if another worker is running.'''
+
+    while True:
+        lockfile = _lock()
+        if lockfile is None:
+            return
+
+        try:
+            while process_jobs():
+                pass
+        finally:
+            lockfile.close()
+
+        # jobs may have been queued after the last check, when the lock
+        # still looked taken to whoever queued them. Under REPEATABLE READ
+        # they are only visible in a new transaction.
+        model.Session().rollback()
+        if not has_jobs():
+            return
+
+def process_jobs():
+    '''Wait for jobs to pile up, then run all of them, rebuilding each
+    board once. Returns False if there was nothing to do.'''
+
+    time.sleep(config.REBUILD_QUEUE_DELAY)
+
+    session = model.Session()
+    table = model.rebuild_queue
+
+    sql = table.select().order_by(table.c.num.asc())
+    rows = session.execute(sql).fetchall()
+    if not rows:
+        session.rollback()
+        return False
+
+    # claim the jobs before running them, so anything queued meanwhile
+    # gets a new entry instead of being merged with one we're handling
+    session.execute(table.delete().where(table.c.num <= rows[-1].num))
+    session.commit()
+
+    jobs = {}
+    for row in rows:
+        jobs.setdefault(row.board, set()).add(row.thread)
+
+    for board_name, threads in sorted(jobs.items()):
+        try:
+            rebuild_board(board_name, threads)
+            session.commit()
+        except:
+            session.rollback()
+            sys.stderr.write('Error in queued rebuild of %s\n' % board_name)
+            traceback.print_exc(file=sys.stderr)
+
+    return True
+
+def rebuild_board(board_name, threads):
+    board_obj = board.get_board(board_name)
+    local.environ['waka.board'] = board_obj
+
+    board_obj.trim_database()
+    # the board lock must not be held while writing to the database
+    model.Session().commit()
+
+    board_obj.build_cache(changed_threads=threads)
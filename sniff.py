@@ -0,0 +1,241 @@
+'''Image types and sizes from file headers. Files are read in blocks through
+a Reader, and the segments in between (EXIF data, ICC profiles, GIF frames)
+are skipped with seek() instead of being read.
+
+SNIFFERS lists the formats that analyze() knows, in the order they're
+tried. Each sniffer takes a Reader and returns (width, height), or None if
+the file isn't in its format.'''
+
+import struct
+
+from util import WakaError
+
+BLOCK_SIZE = 4096
+
+class Reader(object):
+    '''Buffered random access to the start of a file. Offsets are from the
+    beginning of the file.'''
+
+    def __init__(self, file):
+        self.file = file
+        self.offset = 0     # file offset of self.buffer
+        self.buffer = ''
+        self.file.seek(0)
+
+    def read(self, offset, size):
+        '''Returns the size bytes at offset, or fewer at the end of the
+        file'''
+
+        start = offset - self.offset
+        if start < 0 or start > len(self.buffer):
+            # outside the buffer, start a new one
+            self.file.seek(offset)
+            self.offset, self.buffer, start = offset, '', 0
+
+        missing = start + size - len(self.buffer)
+        if missing > 0:
+            self.file.seek(self.offset + len(self.buffer))
+            self.buffer = self.buffer[start:] + \
+                self.file.read(max(missing, BLOCK_SIZE))
+            self.offset += start
+            start = 0
+
+        return self.buffer[start:start + size]
+
+    def find(self, char, offset):
+        '''Returns the offset of the next char from offset on, or -1'''
+
+        while True:
+            block = self.read(offset, BLOCK_SIZE)
+            if not block:
+                return -1
+            found = block.find(char)
+            if found != -1:
+                return offset + found
+            offset += len(block)
+
+JPEG_MAGIC = '\xff\xd8'
+# start of frame markers of the JPEGs that browsers show: baseline, extended
+# and progressive
+JPEG_SOF = (0xc0, 0xc1, 0xc2)
+# markers without a size
+JPEG_STANDALONE = frozenset([0x00, 0x01] + range(0xd0, 0xd9))
+
+def jpeg_size(reader):
+    if reader.read(0, 2) != JPEG_MAGIC:
+        return None
+
+    offset = 2
+    while True:
+        header = reader.read(offset, 4)
+        if header[:1] != '\xff':
+            # garbage between segments
+            offset = reader.find('\xff', offset)
+            if offset == -1:
+                return None
+            header = reader.read(offset, 4)
+        if len(header) < 4:
+            return None
+
+        mark = ord(header[1])
+        if mark == 0xff:
+            # fill byte
+            offset += 1
+            continue
+        if mark in JPEG_STANDALONE:
+            offset += 2
+            continue
+        if mark in (0xda, 0xd9): # SOS/EOI
+            return None
+
+        size = struct.unpack('>H', header[2:])[0]
+        if size < 2:
+            # MS GDI+ JPEG exploit uses short chunks
+            raise WakaError("Possible virus in image")
+
+        if mark in JPEG_SOF:
+            frame = reader.read(offset + 4, 5)
+            if len(frame) < 5:
+                return None
+            bits, height, width = struct.unpack('>BHH', frame)
+            return width, height
+
+        offset += 2 + size
+
+PNG_MAGIC = '\x89PNG\r\n\x1a\n'
+PNG_IHDR = 'IHDR'
+
+def png_size(reader):
+    header = reader.read(0, 24)
+    if len(header) != 24:
+        return None
+
+    magic, length, ihdr, width, height = struct.unpack('>8sL4sLL', header)
+    if magic != PNG_MAGIC or ihdr != PNG_IHDR:
+        return None
+    return width, height
+
+GIF_MAGICS = ('GIF87a', 'GIF89a')
+
+def gif_size(reader):
+    header = reader.read(0, 10)
+    if len(header) != 10:
+        return None
+
+    magic, width, height = struct.unpack('<6sHH', header)
+    if magic not in GIF_MAGICS:
+        return None
+    return width, height
+
+def gif_frames(reader, limit=None):
+    '''Number of frames in a GIF, counting no further than limit. 0 if it
+    isn't a GIF.'''
+
+    header = reader.read(0, 13)
+    if len(header) != 13 or header[:6] not in GIF_MAGICS:
+        return 0
+
+    offset = 13 + _gif_color_table_size(ord(header[10]))
+    frames = 0
+    while limit is None or frames < limit:
+        block = reader.read(offset, 1)
+        if block == ',':
+            # image descriptor, then the image data
+            descriptor = reader.read(offset, 10)
+            if len(descriptor) != 10:
+                break
+            frames += 1
+            offset += 10 + _gif_color_table_size(ord(descriptor[9]))
+            # LZW minimum code size
+            offset += 1
+        elif block == '!':
+            # extension: introducer and label
+            offset += 2
+        else:
+            # trailer, or end of the file
+            break
+
+        offset = _skip_gif_sub_blocks(reader, offset)
+        if offset is None:
+            break
+
+    return frames
+
+def _gif_color_table_size(flags):
+    if flags & 0x80:
+        return 3 << ((flags & 0x07) + 1)
+    return 0
+
+def _skip_gif_sub_blocks(reader, offset):
+    '''Returns the offset after the sub-blocks at offset, or None if the
+    file ends before'''
+
+    while True:
+        size = reader.read(offset, 1)
+        if not size:
+            return None
+        offset += 1 + ord(size)
+        if size == '\0':
+            return offset
+
+def webp_size(reader):
+    header = reader.read(0, 30)
+    if len(header) != 30 or header[:4] != 'RIFF' or header[8:12] != 'WEBP':
+        return None
+
+    chunk = header[12:16]
+    if chunk == 'VP8 ':
+        # lossy: 14 bit sizes after the frame tag and start code
+        if header[23:26] != '\x9d\x01\x2a':
+            return None
+        width, height = struct.unpack('<HH', header[26:30])
+        return width & 0x3fff, height & 0x3fff
+    elif chunk == 'VP8L':
+        # lossless: 14 bit sizes minus one, after the signature
+        if header[20] != '\x2f':
+            return None
+        bits = struct.unpack('<L', header[21:25])[0]
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    elif chunk == 'VP8X':
+        # extended: 24 bit canvas sizes minus one, after the flags
+        width = struct.unpack('<L', header[24:27] + '\0')[0]
+        height = struct.unpack('<L', header[27:30] + '\0')[0]
+        return width + 1, height + 1
+    return None
+
+SNIFFERS = [('jpg', jpeg_size), ('png', png_size), ('gif', gif_size),
+            ('webp', webp_size)]
+
+def analyze(file):
+    '''Returns (ext, width, height) if file is an image in one of the
+    SNIFFERS formats, None otherwise'''
+
+    reader = Reader(file)
+    for ext, sniffer in SNIFFERS:
+        size = sniffer(reader)
+        if size is not None:
+            return (ext,) + tuple(size)
+    return None
+
+def is_animated(filename):
+    '''Whether filename is a GIF with more than one frame'''
+
+    with open(filename, 'rb') as file:
+        return gif_frames(Reader(file), limit=2) > 1
+
+# Starts of programs and scripts
+EXECUTABLE_MAGICS = (
+    '#!',                                       # scripts
+    '\x7fELF',                                  # Linux, BSD
+    'MZ',                                       # Windows
+    '\xfe\xed\xfa\xce', '\xfe\xed\xfa\xcf',     # Mach-O
+    '\xce\xfa\xed\xfe', '\xcf\xfa\xed\xfe',
+    '\xca\xfe\xba\xbe',                         # fat Mach-O, Java classes
+)
+
+def is_executable(head):
+    '''Whether the first bytes of a file look like a program or a script'''
+
+    if head.startswith(EXECUTABLE_MAGICS):
+        return True
+    return head.lstrip()[:5].lower() == '<?php'
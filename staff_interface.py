@@ -13,6 +13,8 @@ import staff
 import model
 import str_format
 import misc
+import ban_index
+import post_cache
 from util import WakaError, local, make_http_forward
 from template import Template
 import config
@@ -178,6 +180,8 @@ class StaffInterface(Template):
                           threads=threads,
                           reportedposts=reports,
                           **kwargs)
+        # these show IP addresses, so don't save them with the public ones
+        self.post_store = post_cache.staff_store
 
     @admin_only
     @interface_for(STAFF_PANEL)
@@ -718,6 +722,9 @@ class StaffInterface(Template):
                             results.append(str(row.fetchall()))
                         except:
                             results.append('OK')
+
+                # the statements may have changed the ban list
+                ban_index.bump_generation()
             else:
                 # Remove board table contents and board list entry.
                 try:
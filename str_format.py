@@ -137,11 +137,65 @@ FC_BOARD_POST_LINK = re.compile('&gt&gt&gt;\/?([0-9a-zA-Z]+)\/?&gt&gt;([0-9]+)')
 FC_BOARD_LINK = re.compile('&gt&gt&gt;\/?([0-9a-zA-Z]+)\/?')
 FC_POST_LINK = re.compile('&gtgt;([0-9]+)')
 
+class PostLinks(object):
+    '''Looks up the boards and posts that post links refer to. prefetch()
+    finds all the links in a comment first, so that they can be looked up
+    with one query per board instead of one per link.'''
+
+    def __init__(self):
+        self.boards = {local.board.name: local.board}
+        self.parents = {}       # board name -> {num: parent or None}
+
+    def prefetch(self, comment):
+        refs = {local.board.name: set()}
+        for name, num in FC_BOARD_POST_LINK.findall(comment):
+            refs.setdefault(name, set()).add(int(num))
+        for name in FC_BOARD_LINK.findall(comment):
+            refs.setdefault(name, set())
+        refs[local.board.name].update([int(x) for x in
+                                       FC_POST_LINK.findall(comment)])
+
+        for name, nums in refs.iteritems():
+            if self.get_board(name) is not None:
+                self.fetch(name, nums)
+
+    def get_board(self, name):
+        '''Returns the Board called name, or None'''
+
+        # import this here to avoid circular imports. ugly, i know.
+        import board
+
+        if name not in self.boards:
+            try:
+                self.boards[name] = board.get_board(name)
+            except board.BoardNotFound:
+                self.boards[name] = None
+        return self.boards[name]
+
+    def fetch(self, name, nums):
+        parents = self.parents.setdefault(name, {})
+        nums = [num for num in nums if num not in parents]
+        if nums:
+            parents.update(dict.fromkeys(nums))
+            parents.update(self.boards[name].get_post_parents(nums))
+
+    def get_parent(self, name, num):
+        '''Returns the parent of post num on board name (0 for threads),
+        or None if there's no such post'''
+
+        if self.get_board(name) is None:
+            return None
+        self.fetch(name, [num])
+        return self.parents[name][num]
+
 def format_comment(comment):
     # hide >>1 references from the quoting code
     for pattern, repl in FC_HIDE_POSTLINKS:
         comment = pattern.sub(repl, comment)
 
+    links = PostLinks()
+    links.prefetch(comment)
+
     def unhide_postlinks(string):
         return (string
             .replace("&gt&gt&gt;", "&gt;&gt;&gt;")
@@ -151,42 +205,37 @@ def format_comment(comment):
     def handler(line):
         '''fix up post link references'''
 
-        # import this here to avoid circular imports. ugly, i know.
-        import board
-
         def board_post_link(match):
             origtext = unhide_postlinks(match.group(0))
-            try:
-                newboard = board.Board(match.group(1))
-                res = newboard.get_post(match.group(2))
-                if res:
-                    return '<a href="%s" onclick="highlight(%s)">%s</a>' % (
-                        newboard.get_reply_link(res.num, res.parent),
-                        match.group(1), origtext)
-            except board.BoardNotFound:
-                pass
+            num = int(match.group(2))
+            parent = links.get_parent(match.group(1), num)
+            if parent is not None:
+                newboard = links.get_board(match.group(1))
+                return '<a href="%s" onclick="highlight(%s)">%s</a>' % (
+                    newboard.get_reply_link(num, parent),
+                    match.group(1), origtext)
             return origtext
         line = FC_BOARD_POST_LINK.sub(board_post_link, line)
 
         def board_link(match):
             origtext = unhide_postlinks(match.group(0))
-            try:
-                newboard = board.Board(match.group(1))
-                return '<a href="%s">%s</a>' % (
-                    newboard.make_path(page=0, url=True),
-                    origtext)
-            except board.BoardNotFound:
+            newboard = links.get_board(match.group(1))
+            if newboard is None:
                 return origtext
+            return '<a href="%s">%s</a>' % (
+                newboard.make_path(page=0, url=True),
+                origtext)
 
         line = FC_BOARD_LINK.sub(board_link, line)
 
         def post_link(match):
             origtext = unhide_postlinks(match.group(0))
-            res = local.board.get_post(match.group(1))
-            if res:
+            num = int(match.group(1))
+            parent = links.get_parent(local.board.name, num)
+            if parent is not None:
                 return '<a href="%s" onclick="highlight(%s)">%s</a>' % (
-                    local.board.get_reply_link(res.num, res.parent),
-                    res.num, origtext)
+                    local.board.get_reply_link(num, parent),
+                    num, origtext)
             else:
                 return origtext
 
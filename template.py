@@ -1,20 +1,31 @@
 import os
 import glob
+import gzip
 import random
 import re
+import fcntl
+import threading
 
 import jinja2
 
 import config, config_defaults
 import strings
 import misc
-from util import local, FileLock
+import util
+import post_cache
+from util import local
 import str_format
 import staff_tasks
 
 TEMPLATES_DIR = os.path.join('templates')
 CACHE_DIR = os.path.join(TEMPLATES_DIR, '.cache')
 
+# Size of the pieces of output sent when streaming pages
+STREAM_CHUNK_SIZE = 8192
+
+# Compression level of the .gz copies of pages written with GZIP_PAGES
+GZIP_LEVEL = 6
+
 _filters = []
 _functions = []
 
@@ -26,22 +37,115 @@ def function(f):
     _functions.append(f.__name__)
     return f
 
+_env = None
+_env_lock = threading.Lock()
+
+_css_files = util.FileCache()
+
+def get_css_files(directory):
+    '''The .css files in directory, listed again when it changes'''
+    return _css_files.get(directory, directory,
+        lambda: sorted(glob.glob(os.path.join(directory, '*.css'))),
+        config.CONFIG_CHECK_INTERVAL)
+
+def _bind(name, decorator):
+    '''Wraps the Template method called name so that it's looked up on the
+    Template instance being rendered, which is passed in the context'''
+    def bound(context, *args, **kwargs):
+        return getattr(context['_template'], name)(*args, **kwargs)
+    bound.__name__ = name
+    return decorator(bound)
+
+def get_environment():
+    '''Returns the process-wide jinja2 environment, creating it if needed.
+    Compiled templates are kept in memory; set TEMPLATE_AUTORELOAD to pick
+    up changes to the template files without restarting.'''
+    global _env
+
+    if _env is not None:
+        return _env
+
+    with _env_lock:
+        if _env is None:
+            if not os.path.exists(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+
+            env = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(TEMPLATES_DIR),
+                bytecode_cache=jinja2.FileSystemBytecodeCache(CACHE_DIR),
+                auto_reload=bool(config.TEMPLATE_AUTORELOAD),
+                cache_size=-1
+            )
+
+            for filter in _filters:
+                env.filters[filter] = _bind(filter, jinja2.contextfilter)
+
+            for function in _functions:
+                env.globals[function] = _bind(function,
+                                              jinja2.contextfunction)
+
+            env.globals['config'] = config
+            env.globals['strings'] = strings
+
+            _env = env
+    return _env
+
+def write_page(board, filename, contents):
+    '''Writes a generated page of board to filename, unless the file already
+    has the same contents. Returns whether it was written.'''
+
+    gzipped = filename + '.gz'
+    if util.file_has_contents(filename, contents):
+        # leave it alone, so that its mtime and caches stay valid
+        if config.GZIP_PAGES and not os.path.exists(gzipped):
+            write_gzip(gzipped, contents)
+        return False
+
+    # the web server may prefer the .gz, so it must never be older
+    if config.GZIP_PAGES:
+        write_gzip(gzipped, contents)
+    elif os.path.exists(gzipped):
+        os.unlink(gzipped)
+
+    if config.USE_TEMPFILES:
+        tempname = os.path.join(os.path.dirname(filename),
+            'tmp' + str(random.randint(1, 1000000000)))
+
+        with open(tempname, 'w') as rc:
+            rc.write(contents)
+
+        # readers see either the old or the new page, so no lock needed
+        os.rename(tempname, filename)
+    else:
+        # lock the page itself, opened without truncating it first
+        with open(filename, 'a') as rc:
+            fcntl.flock(rc, fcntl.LOCK_EX)
+            rc.seek(0)
+            rc.truncate()
+            rc.write(contents)
+
+    os.chmod(filename, 0644)
+    board.log_changed_page(filename)
+    return True
+
+def write_gzip(filename, contents):
+    '''Writes a gzipped copy of a page, to be served as is by web servers
+    that support it (like nginx with gzip_static)'''
+
+    tempname = os.path.join(os.path.dirname(filename),
+        'tmp' + str(random.randint(1, 1000000000)))
+
+    with open(tempname, 'wb') as f:
+        gz = gzip.GzipFile('', 'wb', GZIP_LEVEL, f, mtime=0)
+        gz.write(contents)
+        gz.close()
+
+    os.chmod(tempname, 0644)
+    os.rename(tempname, filename)
+
 class Template(object):
     def __init__(self, name, **vars):
-        if not os.path.exists(CACHE_DIR):
-            os.makedirs(CACHE_DIR)
-
-        # Environment init
-        self.env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(TEMPLATES_DIR),
-            bytecode_cache=jinja2.FileSystemBytecodeCache(CACHE_DIR)
-        )
-
-        for filter in _filters:
-            self.env.filters[filter] = getattr(self, filter)
-
-        for function in _functions:
-            self.env.globals[function] = getattr(self, function)
+        self.env = get_environment()
 
         # Current template init
         self.template = self.env.get_template(name + '.html')
@@ -49,40 +153,87 @@ class Template(object):
         self.environ = local.environ
         self.board = self.environ['waka.board']
 
+        vars['_template'] = self
         vars['environ'] = self.environ
         vars['board'] = self.board
         vars['stylesheets'] = list(self.get_stylesheets(self.board))
-        self.env.globals['config'] = config
-        self.env.globals['strings'] = strings
 
         self.vars = vars
 
+        # where render_post() keeps the fragments, created when needed
+        self.post_store = None
+        self.post_versions = {}
+
     def __iter__(self):
-        yield self.template.render(**self.vars).encode("utf-8")
+        if not config.TEMPLATE_STREAMING:
+            yield self.render()
+            return
+
+        # jinja2 generates lots of tiny strings, send them in bigger pieces
+        chunk = []
+        size = 0
+        for data in self.template.generate(**self.vars):
+            data = data.encode("utf-8")
+            chunk.append(data)
+            size += len(data)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+
+        if chunk:
+            yield ''.join(chunk)
+
+        self.save_posts()
+
+    def render(self):
+        '''Returns the whole page, encoded'''
 
-    def render_to_file(self, filename):
         contents = self.template.render(**self.vars).encode("utf-8")
+        self.save_posts()
+        return contents
 
-        if config.USE_TEMPFILES:
-            tempname = os.path.join(os.path.dirname(filename),
-                'tmp' + str(random.randint(1, 1000000000)))
-
-            with FileLock(tempname):
-                with open(tempname, 'w') as rc:
-                    rc.write(contents)
-
-            with FileLock(filename) as rc:
-                os.rename(tempname, filename)
-        else:
-            with FileLock(filename) as rc:
-                with open(filename, 'w') as rc:
-                    rc.write(contents)
+    def render_to_file(self, filename):
+        '''Writes the page to filename, unless the file already has the same
+        contents. Returns whether it was written.'''
 
-        os.chmod(filename, 0644)
+        return write_page(self.board, filename, self.render())
 
     def update_parameters(self, **kwargs):
         self.vars.update(kwargs)
 
+    def save_posts(self):
+        if self.post_store is not None:
+            self.post_store.save()
+
+    @function
+    def render_post(self, name, post, **context):
+        '''Renders post with the template name, which may only depend on the
+        post, on whether this is a thread page and on the context given.
+        The HTML is reused from an earlier build if none of it changed.'''
+
+        if self.post_store is None:
+            self.post_store = post_cache.DiskStore(self.board)
+
+        thread = self.vars.get('thread')
+        key = '%s %s %s %r %d' % (self.board.name, name, bool(thread),
+                                  sorted(context.items()), post.num)
+
+        if name not in self.post_versions:
+            filename = os.path.join(TEMPLATES_DIR, name + '.html')
+            self.post_versions[name] = post_cache.get_version(self.board,
+                filename, self.environ)
+        stamp = post_cache.get_stamp(post, self.post_versions[name])
+
+        thread_num = post.parent or post.num
+        html = self.post_store.get(thread_num, key, stamp)
+        if html is None:
+            html = self.env.get_template(name + '.html').render(
+                _template=self, environ=self.environ, board=self.board,
+                thread=thread, post=post, **context)
+            self.post_store.put(thread_num, key, stamp, html)
+        return html
+
     @filter
     def reverse_format(self, value, tplstring):
         return tplstring % value
@@ -181,14 +332,14 @@ class Template(object):
         return ', '.join(ret_list)
 
     def get_stylesheets(self, board=None):
-        files = glob.glob(os.path.abspath\
+        files = list(get_css_files(os.path.abspath\
                          (os.path.join(self.environ['DOCUMENT_ROOT'],
                                        config.BOARD_DIR,
-                                       'include/boards/css/*.css')))
+                                       'include/boards/css'))))
         if board is not None:
             # Add board CSS directory, if present.
-            files.extend(glob.glob(os.path.abspath\
-                                   (os.path.join(board.path, 'css/*.css'))))
+            files.extend(get_css_files(os.path.abspath\
+                                       (os.path.join(board.path, 'css'))))
 
         for file in files:
             title = os.path.basename(file) \
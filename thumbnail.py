@@ -0,0 +1,221 @@
+'''Thumbnail backends. With Pillow installed, images are decoded and resized
+inside the process; otherwise ImageMagick's convert is run for each upload.
+THUMBNAIL_BACKEND picks one ('auto', 'pillow' or 'convert').
+
+With THUMBNAIL_WORKERS set, posts are saved before their thumbnails exist,
+and the thumbnails are made by that many background threads per process,
+which take them from a queue.'''
+
+import os
+import sys
+import Queue
+import atexit
+import threading
+import traceback
+
+import werkzeug
+
+import config
+import model
+import misc
+import util
+import sniff
+from util import WakaError, local
+
+try:
+    from PIL import Image, ImageColor, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+# Size of the "Animated" label added under thumbnails of animated GIFs
+LABEL_WIDTH = 100
+LABEL_HEIGHT = 15
+
+# Thumbnails made in another format than their image. Pillow and ImageMagick
+# can be built without a WebP encoder.
+THUMBNAIL_EXTENSIONS = {'webp': 'png'}
+
+def get_backend():
+    backend = config.THUMBNAIL_BACKEND
+    if backend == 'auto':
+        return 'convert' if Image is None else 'pillow'
+    if backend == 'pillow' and Image is None:
+        raise WakaError('THUMBNAIL_BACKEND is pillow, but it is not installed')
+    return backend
+
+def make_thumbnail(filename, thumbnail, width, height, quality, convert):
+    '''Writes a thumbnail of the image in filename, resized to width x
+    height. Returns its size, or (0, 0) if it couldn't be made.'''
+
+    util.make_dirs(os.path.dirname(thumbnail))
+    if get_backend() == 'pillow':
+        return make_thumbnail_pillow(filename, thumbnail, width, height,
+                                     quality)
+    return misc.make_thumbnail(filename, thumbnail, width, height, quality,
+                               convert)
+
+def make_thumbnail_pillow(filename, thumbnail, width, height, quality):
+    '''Same as misc.make_thumbnail, without running ImageMagick'''
+
+    try:
+        animated = sniff.is_animated(filename)
+        image = Image.open(filename)
+
+        # let JPEGs be decoded at a fraction of their size when possible
+        image.draft('RGB', (width, height))
+
+        image = image.convert('RGBA').resize((width, height), Image.ANTIALIAS)
+        if animated:
+            image = add_animated_label(image)
+
+        save_thumbnail(image, thumbnail, quality)
+    except (IOError, ValueError, EOFError, SyntaxError, MemoryError):
+        # SyntaxError: PIL's way of saying "broken file"
+        if os.path.exists(thumbnail):
+            os.unlink(thumbnail)
+        return 0, 0
+
+    if animated:
+        height += LABEL_HEIGHT
+    return width, height
+
+def add_animated_label(image):
+    '''Appends the band that convert's "label:Animated -append" adds'''
+
+    width, height = image.size
+    background = ImageColor.getrgb(config.BG_ANIM_COLOR)
+    labeled = Image.new('RGBA', (max(width, LABEL_WIDTH),
+                                 height + LABEL_HEIGHT), background)
+    labeled.paste(image, ((labeled.size[0] - width) // 2, 0))
+
+    draw = ImageDraw.Draw(labeled)
+    font = ImageFont.load_default()
+    text_width, text_height = draw.textsize('Animated', font=font)
+    draw.text(((labeled.size[0] - text_width) // 2,
+               height + (LABEL_HEIGHT - text_height) // 2),
+              'Animated', font=font,
+              fill=ImageColor.getrgb(config.FG_ANIM_COLOR))
+    return labeled
+
+def save_thumbnail(image, thumbnail, quality):
+    '''Saves an RGBA image in the format given by the thumbnail's
+    extension'''
+
+    ext = os.path.splitext(thumbnail)[1].lower()
+
+    if ext in ('.jpg', '.jpeg'):
+        # no transparency in JPEG, put it on white
+        flat = Image.new('RGB', image.size, (255, 255, 255))
+        flat.paste(image, mask=image.split()[3])
+        flat.save(thumbnail, 'JPEG', quality=quality)
+    elif ext == '.gif':
+        alpha = image.split()[3]
+        image = image.convert('RGB').convert('P', palette=Image.ADAPTIVE,
+                                             colors=255)
+        # the last palette entry is left for transparent pixels
+        image.paste(255, Image.eval(alpha, lambda a: 255 if a < 128 else 0))
+        image.save(thumbnail, 'GIF', transparency=255)
+    else:
+        image.save(thumbnail, 'PNG')
+
+def get_extension(ext):
+    '''Extension of the thumbnails of images with extension ext'''
+    return THUMBNAIL_EXTENSIONS.get(ext, ext)
+
+def get_size(filename, width, height):
+    '''Size that the thumbnail of filename will have once it's made'''
+
+    if sniff.is_animated(filename):
+        height += LABEL_HEIGHT
+    return width, height
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def _get_queue():
+    '''The queue of deferred thumbnails, started along with its worker
+    threads on first use'''
+
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = Queue.Queue()
+            for i in xrange(config.THUMBNAIL_WORKERS):
+                worker = threading.Thread(target=_work, args=(_queue,))
+                # they wait for jobs forever, which mustn't keep the
+                # process from exiting; wait_deferred() runs at exit
+                worker.daemon = True
+                worker.start()
+        return _queue
+
+def _work(queue):
+    while True:
+        job = queue.get()
+        try:
+            _make_deferred(*job)
+        finally:
+            queue.task_done()
+
+def wait_deferred():
+    '''Wait until the thumbnails queued so far are made'''
+
+    if _queue is not None:
+        _queue.join()
+
+atexit.register(wait_deferred)
+
+def defer(filename, thumbnail, width, height, quality, convert):
+    '''Make a thumbnail in the background once the post is saved. See
+    start_deferred().'''
+
+    jobs = local.environ.setdefault('waka.thumbnails', [])
+    jobs.append((filename, thumbnail, width, height, quality, convert))
+
+def start_deferred(board, num, thread):
+    '''Start making the thumbnails deferred while handling post num. It
+    has to be committed already, so that a failure can be written.'''
+
+    jobs = local.environ.pop('waka.thumbnails', [])
+    if not jobs:
+        return
+
+    # a copy, since the request's environ is gone by the time a failure
+    # makes the thread get rebuilt
+    environ = util.proxy_environ()
+    werkzeug.BaseRequest(environ)
+    environ['waka.board'] = board
+
+    queue = _get_queue()
+    for args in jobs:
+        queue.put((environ, board, num, thread, args))
+
+def _make_deferred(environ, board, num, thread, args):
+    local.environ = environ
+    try:
+        width, height = make_thumbnail(*args)
+        if width and height:
+            os.chmod(args[1], 0644)
+        else:
+            _thumbnail_failed(board, num, thread)
+    except:
+        sys.stderr.write('Error while making the thumbnail of %s\n'
+                         % args[0])
+        traceback.print_exc(file=sys.stderr)
+    finally:
+        model.Session.remove()
+        local.environ = {}
+
+def _thumbnail_failed(board, num, thread):
+    '''Show the post without a thumbnail, like when making it fails while
+    posting'''
+
+    session = model.Session()
+    table = board.table
+    session.execute(table.update().where(table.c.num == num)
+                    .values(thumbnail=None, tn_width=0, tn_height=0))
+    session.commit()
+
+    # the index pages too, even with REBUILD_QUEUE on: nobody is waiting
+    # on this thread, and a job queued from here would sit there until the
+    # next post started a worker
+    board.rebuild_threads([thread])
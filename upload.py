@@ -0,0 +1,167 @@
+'''Uploaded files are written straight to the board's IMG_DIR while the
+request body is parsed, and their checksum, size and header are worked out
+on the way, so that process_file only has to rename the file into place.
+
+When the board is named in the query string (as in the post forms), files
+that are over MAX_KB or of a type the board turns down are rejected before
+the rest of the body is read.'''
+
+import os
+import shutil
+import hashlib
+import tempfile
+from io import BytesIO
+
+import werkzeug
+
+import misc
+import sniff
+import strings
+from util import WakaError
+
+# Start of the file kept in memory for analyze_image(). It's all a PNG or
+# GIF needs, and all a JPEG needs unless its EXIF or ICC blocks are huge.
+HEAD_SIZE = 64 * 1024
+
+class Request(werkzeug.BaseRequest):
+    '''Request that streams file uploads into UploadFiles'''
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if not filename:
+            # file input left empty
+            return BytesIO()
+        return UploadFile(filename, self.get_upload_board())
+
+    def get_upload_board(self):
+        # only the query string can be looked at while the body is parsed
+        name = self.args.get('board')
+        if not name:
+            return None
+
+        from board import get_board
+        try:
+            return get_board(name)
+        except WakaError:
+            # reported once the form is parsed
+            return None
+
+class UploadFile(object):
+    '''Temporary file that an upload is written to, keeping its MD5, size
+    and header. It's deleted on close() unless save() moved it.'''
+
+    def __init__(self, filename, board=None):
+        self.filename = filename
+        self.board = board
+        directory = None
+        if board is not None:
+            # same filesystem as the final name, so that save() is a rename
+            directory = board.make_path(dirc='IMG_DIR')
+
+        fd, self.name = tempfile.mkstemp(prefix='.upload', dir=directory)
+        self.file = os.fdopen(fd, 'w+b')
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.head = ''
+        self.checked = False
+        self.analysis = None
+
+    def __getattr__(self, name):
+        # read(), seek() and the rest
+        if name == 'file':
+            raise AttributeError(name)
+        return getattr(self.file, name)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.board and self.size > self.board.options['MAX_KB'] * 1024:
+            self.close()
+            raise WakaError(strings.TOOBIG)
+
+        self.md5.update(data)
+        self.file.write(data)
+
+        if len(self.head) < HEAD_SIZE:
+            self.head += data[:HEAD_SIZE - len(self.head)]
+            if len(self.head) == HEAD_SIZE and self.board:
+                self.check_head()
+
+    def check_head(self):
+        '''Lets the board turn the file down by its header, if that's
+        enough to tell what it is'''
+
+        if self.checked:
+            return
+        self.checked = True
+
+        analysis = self.analyze_head(complete=False)
+        if analysis is not None:
+            try:
+                self.board.check_file_type(*analysis)
+            except WakaError:
+                self.close()
+                raise
+
+    def analyze_head(self, complete):
+        '''analyze_image() of the file from its header, or None if the
+        header isn't enough. complete says whether the whole file has been
+        written.'''
+
+        ext, width, height = misc.analyze_image(BytesIO(self.head),
+                                                self.filename)
+        if width or not self.head.startswith(sniff.JPEG_MAGIC) or \
+           (complete and self.size == len(self.head)):
+            return ext, width, height
+        # a JPEG with its frame header further in
+        return None
+
+    def analyze(self):
+        '''Returns (ext, width, height), like misc.analyze_image()'''
+
+        if self.analysis is None:
+            self.analysis = self.analyze_head(complete=True)
+            if self.analysis is None:
+                self.file.flush()
+                self.file.seek(0)
+                self.analysis = misc.analyze_image(self.file, self.filename)
+        return self.analysis
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+    def save(self, filename):
+        '''Moves the file to filename'''
+
+        self.file.close()
+        # a rename, unless it's on another filesystem
+        shutil.move(self.name, filename)
+        self.name = None
+
+    def close(self):
+        self.file.close()
+        if self.name is not None:
+            try:
+                os.unlink(self.name)
+            except OSError:
+                pass
+            self.name = None
+
+    def __del__(self):
+        if 'file' in self.__dict__:
+            self.close()
+
+def ingest(filestorage):
+    '''The UploadFile of a werkzeug FileStorage, made by reading the file
+    once if it didn't come from Request'''
+
+    if isinstance(filestorage.stream, UploadFile):
+        return filestorage.stream
+
+    upload = UploadFile(filestorage.filename)
+    filestorage.stream.seek(0)
+    while True:
+        buffer = filestorage.stream.read(64 * 1024)
+        if not buffer:
+            break
+        upload.write(buffer)
+    return upload
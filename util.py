@@ -2,6 +2,8 @@ import os
 import sys
 import time
 import errno
+import fcntl
+import hashlib
 import imp
 import Cookie
 import threading
@@ -75,12 +77,13 @@ def module_default(modulename, defaults):
         if not key.startswith('_') and not hasattr(module, key):
             setattr(module, key, defaults[key])
 
-def import2(name, path):
-    '''Imports a module from path without requiring a __init__.py file'''
+def import2(name, path, reload=False):
+    '''Imports a module from path without requiring a __init__.py file.
+    With reload, the module is loaded again even if it was imported before.'''
 
     fullname = '%s.%s' % (path, name)
 
-    if fullname in sys.modules:
+    if fullname in sys.modules and not reload:
         return sys.modules[fullname]
     else:
         modinfo = imp.find_module(name, [path])
@@ -151,78 +154,140 @@ def make_http_forward(location, alternate_method=False):
         return [str('<html><body><a href="%s">%s</a></body></html>' %\
                 ((location, ) * 2))]
 
-# The following code was ripped from
-# http://www.evanfosmark.com/2009/01/
-#   cross-platform-file-locking-support-in-python/
-# I can't really improve on this to my knowledge.
+def make_conditional_response(contents, content_type):
+    '''Pseudo-application to send contents with an ETag, or only a 304 if
+    the client already has them'''
+
+    etag = '"%s"' % hashlib.md5(contents).hexdigest()
+    local.environ['waka.headers'].update({
+        'Content-Type': content_type,
+        'ETag': etag,
+        'Cache-Control': 'no-cache',
+    })
+
+    if_none_match = local.environ.get('HTTP_IF_NONE_MATCH', '')
+    if etag in [x.strip() for x in if_none_match.split(',')]:
+        local.environ['waka.status'] = '304 Not Modified'
+        return []
+    return [contents]
+
+def file_has_contents(filename, contents):
+    '''Whether filename exists and holds exactly contents'''
+
+    try:
+        if os.path.getsize(filename) != len(contents):
+            return False
+        with open(filename, 'rb') as f:
+            return f.read() == contents
+    except (IOError, OSError):
+        return False
+
+def make_dirs(path):
+    '''Creates the directory path and its parents if they don't exist'''
+
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # made by someone else in the meantime
+            if not os.path.isdir(path):
+                raise
+
+class FileCache(object):
+    '''Values loaded from files or directories, kept until the modification
+    time of the file changes. Each file is stat-ed at most once every
+    interval seconds.'''
+
+    def __init__(self):
+        self.entries = {}       # key -> (value, mtime, time of last check)
+        self.lock = threading.Lock()
+
+    def get(self, key, path, load, interval):
+        '''Returns the value for key, calling load() to get it again if path
+        changed. Exceptions from load() are passed on, and not cached.'''
+
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and now - entry[2] < interval:
+            return entry[0]
 
-class FileLockException(Exception):
-    pass
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+
+        if entry is not None and entry[1] == mtime:
+            value = entry[0]
+        else:
+            value = load()
+        with self.lock:
+            self.entries[key] = (value, mtime, now)
+        return value
 
 class FileLock(object):
-    """ A file locking mechanism that has context-manager support so
-        you can use it in a with statement. This should be relatively cross
-        compatible as it doesn't rely on msvcrt or fcntl for the locking.
+    """ An exclusive lock on a file name, held with flock() on a separate
+        "<file_name>.lock" file. Waiting for the lock blocks in the kernel,
+        and the lock is released by the OS if the process dies. Can be used
+        as a context manager, and is reentrant within a thread.
+
+        The .lock file is left behind: deleting it while another process
+        waits on it would let a third one lock a new file of the same name.
     """
 
-    def __init__(self, file_name, timeout=10, delay=.05):
-        """ Prepare the file locker. Specify the file to lock and optionally
-            the maximum timeout and the delay between each attempt to lock.
-        """
-        self.is_locked = False
+    _held = threading.local()
+
+    def __init__(self, file_name):
         self.lockfile = os.path.join(os.getcwd(), "%s.lock" % file_name)
         self.file_name = file_name
-        self.timeout = timeout
-        self.delay = delay
+        self.is_locked = False
+
+    def _held_locks(self):
+        if not hasattr(self._held, 'locks'):
+            # lockfile -> [open file, depth]
+            self._held.locks = {}
+        return self._held.locks
 
     def acquire(self):
-        """ Acquire the lock, if possible. If the lock is in use, it check again
-            every `wait` seconds. It does this until it either gets the lock or
-            exceeds `timeout` number of seconds, in which case it throws
-            an exception.
-        """
-        start_time = time.time()
-        while True:
+        """ Wait until the lock is ours. """
+        if self.is_locked:
+            return
+
+        held = self._held_locks()
+        if self.lockfile in held:
+            held[self.lockfile][1] += 1
+        else:
+            f = open(self.lockfile, 'a')
             try:
-                self.fd = os.open(self.lockfile, os.O_CREAT|os.O_EXCL|os.O_RDWR)
-                break;
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    raise
-                if (time.time() - start_time) >= self.timeout:
-                    raise FileLockException("Timeout occured.")
-                time.sleep(self.delay)
+                while True:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX)
+                        break
+                    except IOError as e:
+                        if e.errno != errno.EINTR:
+                            raise
+            except:
+                f.close()
+                raise
+            held[self.lockfile] = [f, 1]
         self.is_locked = True
 
     def release(self):
-        """ Get rid of the lock by deleting the lockfile.
-            When working in a `with` statement, this gets automatically
-            called at the end.
-        """
-        if self.is_locked:
-            os.close(self.fd)
-            os.unlink(self.lockfile)
-            self.is_locked = False
+        if not self.is_locked:
+            return
+
+        held = self._held_locks()
+        held[self.lockfile][1] -= 1
+        if not held[self.lockfile][1]:
+            # closing the file releases the lock
+            held.pop(self.lockfile)[0].close()
+        self.is_locked = False
 
     def __enter__(self):
-        """ Activated when used in the with statement.
-            Should automatically acquire a lock to be used in the with block.
-        """
-        if not self.is_locked:
-            self.acquire()
+        self.acquire()
         return self
 
     def __exit__(self, type, value, traceback):
-        """ Activated at the end of the with statement.
-            It automatically releases the lock if it isn't locked.
-        """
-        if self.is_locked:
-            self.release()
-
-    def __del__(self):
-        """ Make sure that the FileLock instance doesn't leave a lockfile
-            lying around.
-        """
         self.release()
 
 def proxy_environ():
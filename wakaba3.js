@@ -347,6 +347,46 @@ if(style_cookie)
 	set_stylesheet(title);
 }
 
+function update_thread(script,board,thread,interval)
+{
+	var request=new XMLHttpRequest();
+	request.onreadystatechange=function()
+	{
+		if(request.readyState!=4) return;
+
+		// anything else, like an error page, isn't added to the thread
+		var match=/^<!--new_posts-->([\s\S]*)$/.exec(request.responseText);
+		if(request.status==200&&match&&/\S/.test(match[1]))
+		{
+			var posts=document.createElement("div");
+			posts.innerHTML=match[1];
+
+			var div=document.getElementById("t"+thread);
+			while(posts.firstChild) div.appendChild(posts.firstChild);
+		}
+
+		// stop once the thread is gone
+		if(request.status!=404)
+		setTimeout(function() { update_thread(script,board,thread,interval) },interval*1000);
+	}
+
+	request.open("GET",script+"?task=newposts&board="+encodeURIComponent(board)
+		+"&thread="+thread+"&since="+last_reply(thread)+"&format=html",true);
+	request.send(null);
+}
+
+function last_reply(thread)
+{
+	var last=thread;
+	var cells=document.getElementById("t"+thread).getElementsByTagName("td");
+	for(var i=0;i<cells.length;i++)
+	{
+		var match=/^reply([0-9]+)$/.exec(cells[i].id);
+		if(match&&parseInt(match[1])>last) last=parseInt(match[1]);
+	}
+	return last;
+}
+
 function threadHide(id)
 {
 	toggleHidden(id);
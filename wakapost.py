@@ -15,7 +15,7 @@ class WakaPost(object):
         'num', 'parent', 'timestamp', 'lasthit', 'ip', 'date', 'name', 'trip',
         'email', 'subject', 'password', 'comment', 'size', 'md5',
         'width', 'height', 'thumbnail', 'tn_width', 'tn_height', 'lastedit',
-        'lastedit_ip', '_admin_post', 'stickied', 'locked',
+        'lastedit_ip', '_admin_post', 'stickied', 'locked', 'abbreviation',
         # extensions
         'abbrev', 'nofile', 'req_file', 'filename', 'req_no_format',
         'killtrip', 'postfix', 'ninja'
@@ -48,6 +48,7 @@ class WakaPost(object):
         self.timestamp = 0
 
         self.abbrev = 0
+        self.abbreviation = None
 
         # tri-state: True, False, or None for unset
         self.stickied = None
@@ -105,7 +106,43 @@ class WakaPost(object):
             locked=self.locked,
             lastedit_ip=self.lastedit_ip,
             lasthit=self.lasthit,
-            lastedit=self.lastedit)
+            lastedit=self.lastedit,
+            abbreviation=self.abbreviation)
+
+    @property
+    def json_values(self):
+        '''Return a dict of the values shown on the board pages, for their
+        JSON versions'''
+
+        values = dict(
+            num=self.num,
+            parent=self.parent,
+            timestamp=self.timestamp,
+            date=self.date,
+            name=self.name,
+            trip=self.trip,
+            email=self.email,
+            subject=self.subject,
+            comment=self.comment,
+            lastedit=self.lastedit or None,
+            admin_post=self.admin_post,
+            stickied=bool(self.stickied),
+            # 'yes', '' or False ('0' on MySQL), as the templates see it
+            locked=(self.locked == 'yes'),
+            abbrev=bool(self.abbrev))
+
+        if self.filename:
+            values.update(
+                image=self.filename,
+                size=self.size,
+                md5=self.md5,
+                width=self.width,
+                height=self.height,
+                thumbnail=self.thumbnail or None,
+                tn_width=int(self.tn_width or 0),
+                tn_height=int(self.tn_height or 0))
+
+        return values
 
     @classmethod
     def from_request(cls, request):
@@ -4,16 +4,15 @@ import os
 import sys
 import traceback
 
-import fcgi
-import werkzeug
-
 import config, config_defaults
 import app
 import cli
 import util
 import model
+import upload
+import rebuild_queue
 import interboard
-from board import Board, NoBoard
+from board import get_board, NoBoard
 from util import WakaError, local
 
 @util.headers
@@ -21,17 +20,22 @@ def application(environ, start_response):
     '''Main routing application'''
 
     local.environ = environ
-    request = werkzeug.BaseRequest(environ)
+    request = upload.Request(environ)
 
-    task = request.values.get('task', request.values.get('action', ''))
-    boardname = request.values.get('board', '')
+    # Indicate "pop-up window" UI style.
+    environ['waka.fromwindow'] = False
+    environ['waka.rootpath'] = os.path.join('/', config.BOARD_DIR, '')
 
+    try:
+        # reads the form, where uploads can be turned down
+        task = request.values.get('task', request.values.get('action', ''))
+        boardname = request.values.get('board', '')
+    except WakaError, e:
+        environ['waka.board'] = NoBoard()
+        return app.error(environ, start_response, e)
 
     environ['waka.task'] = task
     environ['waka.boardname'] = boardname
-    # Indicate "pop-up window" UI style.
-    environ['waka.fromwindow'] = False
-    environ['waka.rootpath'] = os.path.join('/', config.BOARD_DIR, '')
 
     if not task and not boardname:
         environ['waka.board'] = NoBoard()
@@ -40,7 +44,7 @@ def application(environ, start_response):
     environ['waka.board'] = NoBoard()
     try:
         if boardname:
-            environ['waka.board'] = Board(boardname)
+            environ['waka.board'] = get_board(boardname)
         elif task not in ('entersetup', 'setup', 'loginpanel'):
             raise WakaError("No board parameter set")
         elif task == 'loginpanel':
@@ -59,8 +63,10 @@ def application(environ, start_response):
         return ["Error initializing database: %s" % e.args[0]]
 
     try:
-        # wrap with list() to run inside this try..except
-        return list(function(environ, start_response))
+        # run the task up to its first piece of output inside this
+        # try..except, so that errors before that get an error page
+        result = iter(function(environ, start_response))
+        first = next(result, None)
     except WakaError, e:
         return app.error(environ, start_response, e)
     except:
@@ -68,13 +74,34 @@ def application(environ, start_response):
         traceback.print_exc()
         return app.error(environ, start_response)
 
+    if first is None:
+        return []
+    return stream(first, result)
+
+def stream(first, rest):
+    '''Yields the rest of a response that has already started'''
+
+    yield first
+    try:
+        for data in rest:
+            yield data
+    except:
+        # too late for an error page
+        traceback.print_exc()
+
 
 def cleanup(*args, **kwargs):
     '''Destroy the thread-local session and environ'''
     session = model.Session()
     session.commit()
     session.transaction = None  # fix for a circular reference
+    rebuild_queue.start_worker()
     model.Session.remove()
+
+    request = local.environ.get('werkzeug.request')
+    if request is not None:
+        # deletes uploads that weren't saved
+        request.close()
     local.environ = {}
 
 application = util.cleanup(application, cleanup)
@@ -89,7 +116,7 @@ def main():
         return
 
     if not sys.argv[1:] or sys.argv[1] == 'fcgi':
-        fcgi.WSGIServer(application).run()
+        cli.make_fcgi_server(application).run()
     else:
         cli.handle_command(sys.argv[1:], application)
         cleanup()